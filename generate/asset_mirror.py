@@ -0,0 +1,281 @@
+import asyncio
+import hashlib
+import io
+import json
+import os
+import re
+import threading
+import time
+
+from PIL import Image
+
+from generate import http_client
+from generate.data_version import generate_path, list_files, res_path
+
+res_base_url = "https://raw.githubusercontent.com/Mar-7th/StarRailRes/master/"
+# ダウンロード元 (テストではローカルの HTTP サーバーに向けられる)
+ASSET_BASE_URL = os.environ.get("ASSET_BASE_URL", res_base_url)
+ASSET_MANIFEST_PATH = os.environ.get("ASSET_MANIFEST_PATH", f"{generate_path}/asset_manifest.json")
+ASSET_PREFETCH_CONCURRENCY = int(os.environ.get("ASSET_PREFETCH_CONCURRENCY", 8))
+# index_min から集める画像 (カードで使うアイコンと立ち絵)
+ASSET_PREFETCH_PREFIXES = tuple(os.environ.get("ASSET_PREFETCH_PREFIXES", "icon/,image/character_portrait/").split(","))
+# カードを描く前に足りない画像のダウンロードを待つ秒数 (過ぎたら透明のまま描く)
+ASSET_FETCH_TIMEOUT = float(os.environ.get("ASSET_FETCH_TIMEOUT", 5))
+# ダウンロードに失敗した画像はこの秒数のあいだ取り直さない
+ASSET_RETRY_SECONDS = float(os.environ.get("ASSET_RETRY_SECONDS", 300))
+
+asset_pattern = re.compile(r"^(icon|image)/[\w\-./]+\.png$")
+asset_dirs = ("icon", "image")
+
+
+class AssetError(Exception):
+    pass
+
+
+def is_asset_path(path):
+    return bool(asset_pattern.match(path)) and ".." not in path
+
+
+def get_local_path(path):
+    return f"{generate_path}/{path}"
+
+
+def collect_asset_paths(lang="en"):
+    # index_min の JSON に出てくる画像のパス (画像は言語によらない)
+    paths = set()
+
+    def walk(value):
+        if isinstance(value, dict):
+            for v in value.values():
+                walk(v)
+        elif isinstance(value, list):
+            for v in value:
+                walk(v)
+        elif isinstance(value, str) and value.startswith(ASSET_PREFETCH_PREFIXES) and is_asset_path(value):
+            paths.add(value)
+
+    index_path = f"{res_path}/index_min/{lang}"
+    if os.path.isdir(index_path):
+        for name in sorted(os.listdir(index_path)):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(f"{index_path}/{name}", encoding="utf-8") as f:
+                    walk(json.load(f))
+            except (OSError, ValueError) as e:
+                print(f"asset index {name} failed")
+                print(e)
+    return sorted(paths)
+
+
+class AssetMirror:
+    """Local copy of the StarRailRes images used by cards, with a manifest of verified files.
+
+    Files are written as the original bytes through a temporary file and os.replace, so a
+    render never reads a half-written image. Missing images are downloaded before the render
+    is submitted; only images that fail or time out are drawn as placeholders.
+    """
+
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        self.downloads = 0
+        self.failures = 0
+        self.placeholders = 0
+        self.retry_skips = 0
+        self.last_prefetch = None
+        self._files = None
+        self._failed_at = {}
+        self._dirty = False
+        self._task = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Read the manifest and pick up images already on disk (e.g. from older versions)."""
+        with self._lock:
+            if self._files is not None:
+                return self._files
+        files = {}
+        try:
+            with open(self.manifest_path, encoding="utf-8") as f:
+                manifest = json.load(f)
+            for path, (size, digest) in manifest.get("files", {}).items():
+                # 消えた・書き換わったファイルは載せない
+                if is_asset_path(path) and os.path.getsize(get_local_path(path)) == size:
+                    files[path] = (size, digest)
+        except (OSError, ValueError, TypeError):
+            pass
+        dirty = False
+        for asset_dir in asset_dirs:
+            for local_path in list_files(get_local_path(asset_dir)):
+                path = os.path.relpath(local_path, generate_path).replace(os.sep, "/")
+                if path in files or not is_asset_path(path):
+                    continue
+                with open(local_path, "rb") as f:
+                    content = f.read()
+                files[path] = (len(content), hashlib.sha1(content).hexdigest())
+                dirty = True
+        with self._lock:
+            if self._files is None:
+                self._files = files
+                self._dirty = dirty
+            return self._files
+
+    def is_present(self, path):
+        return path in self.load()
+
+    def get_digest(self, path):
+        # 手元の画像の内容の sha1 (無ければ None)
+        entry = self.load().get(path)
+        return entry[1] if entry is not None else None
+
+    def get_digests(self, paths):
+        return {path: self.get_digest(path) for path in paths}
+
+    def known_digests(self):
+        return {digest for _, digest in list(self.load().values())}
+
+    def save_manifest(self):
+        # マニフェストも一時ファイル経由で置き換える
+        with self._lock:
+            if self._files is None or not self._dirty:
+                return False
+            manifest = {"files": {path: list(entry) for path, entry in sorted(self._files.items())}}
+            self._dirty = False
+        tmp_path = f"{self.manifest_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, separators=(",", ":"))
+        os.replace(tmp_path, self.manifest_path)
+        return True
+
+    def _write(self, path, content):
+        # 画像として読めることを確かめてから元のバイト列のまま置く (再エンコードしない)
+        try:
+            with Image.open(io.BytesIO(content)) as img:
+                img.verify()
+        except Exception as e:
+            raise AssetError(f"{path}: {e!r}")
+        local_path = get_local_path(path)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        tmp_path = f"{local_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, local_path)
+        self.load()
+        with self._lock:
+            self._files[path] = (len(content), hashlib.sha1(content).hexdigest())
+            self._dirty = True
+        return local_path
+
+    async def download(self, path):
+        if not is_asset_path(path):
+            raise AssetError(f"invalid asset path {path}")
+        url = ASSET_BASE_URL + path
+        try:
+            async with http_client.get_session().get(url) as response:
+                if response.status != 200:
+                    raise AssetError(f"{url} {response.status}")
+                content = await response.read()
+            local_path = await asyncio.to_thread(self._write, path, content)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.failures += 1
+            self._failed_at[path] = time.time()
+            raise
+        self.downloads += 1
+        self._failed_at.pop(path, None)
+        return local_path
+
+    async def fetch(self, path):
+        # 同じ画像を同時にダウンロードしない
+        if self.is_present(path):
+            return get_local_path(path)
+        return await http_client.image_flight.do(ASSET_BASE_URL + path, lambda: self.download(path))
+
+    def fetch_later(self, path):
+        failed_at = self._failed_at.get(path)
+        if failed_at is not None and time.time() - failed_at < ASSET_RETRY_SECONDS:
+            self.retry_skips += 1
+            return None
+        task = http_client.image_flight.start(ASSET_BASE_URL + path, lambda: self.download(path))
+        task.add_done_callback(log_fetch_result)
+        return task
+
+    async def resolve(self, paths, timeout=ASSET_FETCH_TIMEOUT):
+        """Download the paths that are not mirrored yet; return those still missing (failed or timed out)."""
+        files = self.load()
+        missing = [path for path in paths if path not in files]
+        if not missing:
+            return []
+        tasks = [self.fetch_later(path) for path in missing if is_asset_path(path)]
+        tasks = [task for task in tasks if task is not None]
+        if tasks:
+            # 時間切れでもダウンロードは裏で続く (次のリクエストで使われる)
+            await asyncio.wait(tasks, timeout=timeout)
+        missing = [path for path in missing if not self.is_present(path)]
+        self.placeholders += len(missing)
+        return missing
+
+    async def prefetch(self, extra_paths=()):
+        start = time.perf_counter()
+        paths = await asyncio.to_thread(collect_asset_paths)
+        paths = sorted(set(paths) | set(extra_paths))
+        files = await asyncio.to_thread(self.load)
+        missing = [path for path in paths if path not in files]
+        semaphore = asyncio.Semaphore(ASSET_PREFETCH_CONCURRENCY)
+
+        async def fetch_one(path):
+            async with semaphore:
+                try:
+                    await self.fetch(path)
+                    return True
+                except Exception as e:
+                    print(f"asset prefetch {path} failed")
+                    print(repr(e))
+                    return False
+
+        results = await asyncio.gather(*(fetch_one(path) for path in missing))
+        await asyncio.to_thread(self.save_manifest)
+        self.last_prefetch = {
+            "referenced": len(paths),
+            "missing": len(missing),
+            "downloaded": sum(results),
+            "failed": len(results) - sum(results),
+            "seconds": round(time.perf_counter() - start, 3),
+            "finished_at": time.time(),
+        }
+        return self.last_prefetch
+
+    def start_prefetch(self, extra_paths=()):
+        # 実行中ならそのまま (同期のたびに呼ばれる)
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self.prefetch(extra_paths))
+        return self._task
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    def stats(self):
+        with self._lock:
+            files = dict(self._files or {})
+        return {
+            "files": len(files),
+            "bytes": sum(size for size, _ in files.values()),
+            "downloads": self.downloads,
+            "failures": self.failures,
+            "placeholders": self.placeholders,
+            "retry_skips": self.retry_skips,
+            "prefetching": self._task is not None and not self._task.done(),
+            "last_prefetch": self.last_prefetch,
+        }
+
+
+def log_fetch_result(task):
+    # 裏で始めたダウンロードの失敗はここで出す (download でも数えている)
+    if not task.cancelled() and task.exception() is not None:
+        print("asset fetch failed")
+        print(repr(task.exception()))
+
+
+asset_mirror = AssetMirror(ASSET_MANIFEST_PATH)
@@ -0,0 +1,108 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+from generate.data_version import data_version
+
+bkg_path = f"{os.path.dirname(os.path.abspath(__file__))}/assets/bkg.png"
+elements_json_path = f"{os.path.dirname(os.path.abspath(__file__))}/StarRailRes/index_min/en/elements.json"
+# 元素7色 x 数サイズ分あれば足りる
+BACKGROUND_CACHE_MAX_ENTRIES = int(os.environ.get("BACKGROUND_CACHE_MAX_ENTRIES", 64))
+
+
+def get_signature():
+    # 色は引数で受け取るので bkg.png (assets) の内容だけで決まる。プロセスごとの世代番号ではなく内容のハッシュで見る
+    return data_version.digest("assets")
+
+
+def get_element_colors():
+    # StarRailRes の elements.json にある元素の色 (無ければ空)
+    try:
+        with open(elements_json_path, encoding="utf-8") as f:
+            elements_json = json.load(f)
+    except (OSError, ValueError):
+        return []
+    return list(dict.fromkeys(v["color"] for v in elements_json.values() if isinstance(v, dict) and "color" in v))
+
+
+def get_tint(color_code, alpha):
+    return int(color_code[1:3], 16), int(color_code[3:5], 16), int(color_code[5:7], 16), alpha
+
+
+class BackgroundCache:
+    """bkg.png with the element tint already composited, keyed by (color, size).
+
+    Everything is rebuilt when the content of assets changes. get() returns a copy that
+    the caller may draw on; get_tile() returns a shared image that must not be modified.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.signature = None
+        self.hits = 0
+        self.misses = 0
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_cached(self, key, build):
+        signature = get_signature()
+        with self._lock:
+            if signature != self.signature:
+                self._images.clear()
+                self.signature = signature
+            img = self._images.get(key)
+            if img is not None:
+                self._images.move_to_end(key)
+                self.hits += 1
+                return img
+            self.misses += 1
+        img = build()
+        with self._lock:
+            if self.signature == signature:
+                self._images[key] = img
+                while len(self._images) > self.max_entries:
+                    self._images.popitem(last=False)
+        return img
+
+    def _build_background(self, color_code, size):
+        with Image.open(bkg_path) as src:
+            img = src.convert('RGBA')
+        if img.size != size:
+            img = img.resize(size, Image.LANCZOS)
+        return Image.alpha_composite(img, Image.new('RGBA', size, get_tint(color_code, 100)))
+
+    def get(self, color_code, size):
+        img = self._get_cached(("background", color_code, size),
+                               lambda: self._build_background(color_code, size))
+        return img.copy()
+
+    def get_tile(self, fill, size):
+        # 一部分だけに重ねる単色の半透明レイヤー (alpha_composite で貼る)
+        return self._get_cached(("tile", fill, size), lambda: Image.new('RGBA', size, fill))
+
+    def preload(self, sizes):
+        colors = get_element_colors()
+        for size in sizes:
+            for color_code in colors:
+                self._get_cached(("background", color_code, size),
+                                 lambda: self._build_background(color_code, size))
+        return len(colors)
+
+    def clear(self):
+        with self._lock:
+            self._images.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._images),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+background_cache = BackgroundCache(BACKGROUND_CACHE_MAX_ENTRIES)
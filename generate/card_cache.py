@@ -0,0 +1,177 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+CARD_CACHE_MAX_BYTES = int(os.environ.get("CARD_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+# 設定したときだけディスクにも保存する
+CARD_CACHE_DIR = os.environ.get("CARD_CACHE_DIR", "")
+CARD_CACHE_DISK_MAX_BYTES = int(os.environ.get("CARD_CACHE_DISK_MAX_BYTES", 1024 * 1024 * 1024))
+
+
+def make_card_key(*parts):
+    """Digest of everything that affects a rendered card (JSON-serializable parts)."""
+    content = json.dumps(parts, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def get_entry_size(entry):
+    return len(entry["image"]) + 256
+
+
+class CardCache:
+    def __init__(self, max_bytes, disk_path="", disk_max_bytes=0):
+        self.max_bytes = max_bytes
+        self.disk_path = disk_path
+        self.disk_max_bytes = disk_max_bytes
+        self.current_bytes = 0
+        self.disk_bytes = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.write_errors = 0
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        size = get_entry_size(entry)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = entry
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, old = self._entries.popitem(last=False)
+                self.current_bytes -= get_entry_size(old)
+                self.evictions += 1
+
+    def _read_disk(self, key):
+        try:
+            with open(f"{self.disk_path}/{key}.json", encoding="utf-8") as f:
+                entry = json.load(f)
+            with open(f"{self.disk_path}/{key}.img", 'rb') as f:
+                entry["image"] = f.read()
+            return entry
+        except (OSError, ValueError):
+            return None
+
+    def _write_disk(self, key, entry):
+        # 書けなくても描画済みのカードはそのまま返す (ディスクが一杯など)
+        meta = {k: v for k, v in entry.items() if k != "image"}
+        try:
+            os.makedirs(self.disk_path, exist_ok=True)
+            for suffix, data in (("img", entry["image"]),
+                                 ("json", json.dumps(meta, ensure_ascii=False).encode("utf-8"))):
+                # 同じディレクトリを使う他のプロセス・スレッドと一時ファイルが重ならないように
+                tmp_path = f"{self.disk_path}/{key}.{suffix}.{os.getpid()}.{threading.get_ident()}.tmp"
+                try:
+                    with open(tmp_path, 'wb') as f:
+                        f.write(data)
+                    os.replace(tmp_path, f"{self.disk_path}/{key}.{suffix}")
+                except OSError:
+                    try:
+                        os.remove(tmp_path)
+                    except OSError:
+                        pass
+                    raise
+            self._prune_disk(len(entry["image"]) + len(meta))
+        except OSError as e:
+            with self._lock:
+                self.write_errors += 1
+            print("card cache write failed")
+            print(e)
+
+    def _prune_disk(self, added_bytes):
+        with self._lock:
+            if self.disk_bytes is None:
+                self.disk_bytes = sum(e.stat().st_size for e in os.scandir(self.disk_path) if e.is_file())
+            else:
+                self.disk_bytes += added_bytes
+            if self.disk_bytes <= self.disk_max_bytes:
+                return
+            # 古いものから消して 9 割まで減らす
+            files = sorted((e for e in os.scandir(self.disk_path) if e.is_file()), key=lambda e: e.stat().st_mtime)
+            self.disk_bytes = sum(e.stat().st_size for e in files)
+            for e in files:
+                if self.disk_bytes <= self.disk_max_bytes * 0.9:
+                    break
+                try:
+                    size = e.stat().st_size
+                    os.remove(e.path)
+                    self.disk_bytes -= size
+                except OSError:
+                    pass
+
+    async def get_or_render(self, key, render_func):
+        """Return the cached entry for key, or run render_func() once for all concurrent callers.
+
+        render_func is a coroutine function returning a dict with "image" bytes, or a dict with
+        "detail" on failure (which is not cached).
+        """
+        entry = self.get(key)
+        if entry is not None:
+            self.hits += 1
+            return entry, "HIT"
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            entry, _ = await asyncio.shield(task)
+            return entry, "COALESCED"
+        task = asyncio.ensure_future(self._load_or_render(key, render_func))
+        self._inflight[key] = task
+        task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _load_or_render(self, key, render_func):
+        if self.disk_path:
+            entry = await asyncio.to_thread(self._read_disk, key)
+            if entry is not None:
+                self.disk_hits += 1
+                self.put(key, entry)
+                return entry, "HIT"
+        self.misses += 1
+        entry = await render_func()
+        if "detail" not in entry:
+            self.put(key, entry)
+            if self.disk_path:
+                await asyncio.to_thread(self._write_disk, key, entry)
+        return entry, "MISS"
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "disk_path": self.disk_path,
+                "disk_bytes": self.disk_bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions,
+                "write_errors": self.write_errors,
+                "inflight": len(self._inflight),
+            }
+
+
+card_cache = CardCache(CARD_CACHE_MAX_BYTES, CARD_CACHE_DIR, CARD_CACHE_DISK_MAX_BYTES)
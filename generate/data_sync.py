@@ -0,0 +1,173 @@
+import asyncio
+import os
+import time
+
+from generate.data_version import res_path
+
+generate_path = os.path.dirname(os.path.abspath(__file__))
+score_repo_path = f"{generate_path}/StarRailScore"
+STARRAILRES_REPO_URL = os.environ.get("STARRAILRES_REPO_URL", "https://github.com/Mar-7th/StarRailRes.git")
+# 空なら StarRailScore は clone しない (checkout があれば pull だけする)
+STARRAILSCORE_REPO_URL = os.environ.get("STARRAILSCORE_REPO_URL", "")
+GIT_TIMEOUT = float(os.environ.get("GIT_TIMEOUT", 300))
+
+
+class GitError(Exception):
+    pass
+
+
+async def run_git(*args, cwd):
+    # イベントループを止めず、プロセスの cwd も変えずに git を実行する
+    process = await asyncio.create_subprocess_exec(
+        "git", *args, cwd=cwd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+        env={**os.environ, "GIT_TERMINAL_PROMPT": "0"})
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), GIT_TIMEOUT)
+    except BaseException:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+    if process.returncode != 0:
+        raise GitError(f"git {' '.join(args)}: {stderr.decode(errors='replace').strip()}")
+    return stdout.decode(errors="replace").strip()
+
+
+class DataRepo:
+    """A git checkout under generate/ that is kept up to date in the background."""
+
+    def __init__(self, name, path, url=None, sparse=None, required=None):
+        self.name = name
+        self.path = path
+        self.url = url
+        self.sparse = sparse
+        # これがあれば使える checkout とみなす
+        self.required = required or path
+        self.revision = None
+        self.synced_at = None
+        self.syncs = 0
+        self.changes = 0
+        self.failures = 0
+        self.last_error = None
+
+    def is_git(self):
+        # .git が無いのに git を実行すると親のリポジトリを操作してしまう
+        return os.path.exists(f"{self.path}/.git")
+
+    def has_checkout(self):
+        return os.path.exists(self.required)
+
+    async def get_revision(self):
+        return await run_git("rev-parse", "HEAD", cwd=self.path)
+
+    async def sync(self):
+        """Clone or fast-forward the checkout; return True if its files changed."""
+        if not self.is_git():
+            if not self.url:
+                return False
+            await run_git("clone", "--filter=blob:none", "--no-checkout", self.url, self.path,
+                          cwd=os.path.dirname(self.path))
+            if self.sparse:
+                await run_git("sparse-checkout", "set", *self.sparse, cwd=self.path)
+            await run_git("checkout", cwd=self.path)
+            self.revision = await self.get_revision()
+            return True
+        before = await self.get_revision()
+        # 通信は fetch だけで行い、作業ツリーの更新は fast-forward で短く済ませる
+        await run_git("fetch", cwd=self.path)
+        await run_git("merge", "--ff-only", "@{u}", cwd=self.path)
+        self.revision = await self.get_revision()
+        return self.revision != before
+
+    def stats(self):
+        return {
+            "git": self.is_git(),
+            "checkout": self.has_checkout(),
+            "revision": self.revision,
+            "synced_at": self.synced_at,
+            "syncs": self.syncs,
+            "changes": self.changes,
+            "failures": self.failures,
+            "last_error": self.last_error,
+        }
+
+
+class DataSync:
+    """Background git sync of StarRailRes/StarRailScore.
+
+    After a repo changes, its reload callbacks rebuild the in-memory data off the event loop and
+    swap it in, so requests keep using the last good data until then. The app is ready once
+    StarRailRes is checked out and its data has been loaded.
+    """
+
+    def __init__(self, repos):
+        self.repos = {repo.name: repo for repo in repos}
+        self.loaded = {repo.name: False for repo in repos}
+        self._reloaders = {repo.name: [] for repo in repos}
+        self._locks = {}
+
+    def on_change(self, name, func):
+        # func はコルーチン関数 (repo が変わった後と最初の読み込みで呼ぶ)
+        self._reloaders[name].append(func)
+
+    def _get_lock(self, name):
+        if name not in self._locks:
+            self._locks[name] = asyncio.Lock()
+        return self._locks[name]
+
+    async def load(self, name):
+        # 手元の checkout から読み込む (通信しない)
+        repo = self.repos[name]
+        if not repo.has_checkout():
+            return False
+        if repo.is_git() and repo.revision is None:
+            try:
+                repo.revision = await repo.get_revision()
+            except GitError:
+                pass
+        for func in self._reloaders[name]:
+            await func()
+        self.loaded[name] = True
+        return True
+
+    async def sync(self, name):
+        repo = self.repos[name]
+        async with self._get_lock(name):
+            repo.syncs += 1
+            try:
+                changed = await repo.sync()
+            except (GitError, OSError, asyncio.TimeoutError) as e:
+                # 失敗しても前の checkout をそのまま使う
+                repo.failures += 1
+                repo.last_error = str(e) or repr(e)
+                print(f"data sync {name} failed")
+                print(repo.last_error)
+                changed = False
+            else:
+                repo.synced_at = time.time()
+                repo.last_error = None
+            if changed:
+                repo.changes += 1
+            if changed or not self.loaded[name]:
+                await self.load(name)
+            return changed
+
+    async def sync_all(self):
+        return {name: await self.sync(name) for name in self.repos}
+
+    def is_ready(self):
+        return self.loaded["StarRailRes"]
+
+    def stats(self):
+        return {
+            "ready": self.is_ready(),
+            "loaded": dict(self.loaded),
+            "repos": {name: repo.stats() for name, repo in self.repos.items()},
+        }
+
+
+data_sync = DataSync([
+    DataRepo("StarRailRes", res_path, STARRAILRES_REPO_URL, sparse=["index_min"], required=f"{res_path}/index_min"),
+    DataRepo("StarRailScore", score_repo_path, STARRAILSCORE_REPO_URL or None,
+             required=f"{score_repo_path}/score.json"),
+])
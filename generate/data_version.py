@@ -0,0 +1,126 @@
+import hashlib
+import os
+import threading
+
+generate_path = os.path.dirname(os.path.abspath(__file__))
+res_path = f"{generate_path}/StarRailRes"
+
+
+def list_files(path):
+    # path 以下のファイル (隠しファイルと一時ファイルを除く) を並べて返す
+    if os.path.isfile(path):
+        return [path]
+    files = []
+    for root, dirs, names in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        files += [f"{root}/{name}" for name in sorted(names) if not name.startswith(".") and not name.endswith(".tmp")]
+    return files
+
+
+# グループ名 -> 内容を見るファイル・ディレクトリ (キャッシュはグループ単位で無効にする)
+data_groups = {
+    "res_index": [f"{res_path}/index_min"],
+    "weights": [f"{generate_path}/StarRailScore/score.json", f"{generate_path}/max.json",
+                f"{generate_path}/relic_id.json"],
+    "rolls": [f"{generate_path}/rolls.json"],
+    "assets": [f"{generate_path}/assets"],
+}
+
+
+class DataVersion:
+    """Content-hash manifest of the data files, with a generation number per group.
+
+    refresh() rehashes files whose mtime/size changed; every group whose digest changed gets
+    the next data version as its generation. Caches remember the generation they were built
+    from and rebuild when get(group) differs, so only caches of changed groups are dropped.
+    """
+
+    def __init__(self, groups):
+        self.groups = groups
+        self.version = 0
+        self.generations = {}
+        self.digests = {}
+        self.refreshes = 0
+        self.rehashed = 0
+        # path -> (mtime_ns, size, sha1)
+        self._file_digests = {}
+        self._lock = threading.Lock()
+
+    def _hash_file(self, path):
+        stat = os.stat(path)
+        cached = self._file_digests.get(path)
+        if cached is not None and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+            return cached[2]
+        h = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(chunk)
+        digest = h.hexdigest()
+        self._file_digests[path] = (stat.st_mtime_ns, stat.st_size, digest)
+        self.rehashed += 1
+        return digest
+
+    def _hash_group(self, name):
+        h = hashlib.sha1()
+        for root in self.groups[name]:
+            for path in list_files(root):
+                try:
+                    digest = self._hash_file(path)
+                except OSError:
+                    continue
+                h.update(f"{os.path.relpath(path, generate_path)}\0{digest}\n".encode("utf-8"))
+        return h.hexdigest()
+
+    def refresh(self, names=None):
+        """Rehash the given groups (all by default) and return the names that changed."""
+        names = list(self.groups) if names is None else names
+        with self._lock:
+            self.refreshes += 1
+            digests = {name: self._hash_group(name) for name in names}
+            changed = [name for name, digest in digests.items() if self.digests.get(name) != digest]
+            if changed:
+                self.version += 1
+                for name in changed:
+                    self.digests[name] = digests[name]
+                    self.generations[name] = self.version
+            return changed
+
+    def get(self, name):
+        # まだ計算していなければここで計算する
+        generation = self.generations.get(name)
+        if generation is None:
+            self.refresh([name])
+            generation = self.generations[name]
+        return generation
+
+    def digest(self, *names):
+        # 再起動しても同じ内容なら同じ値 (ディスクに置くキャッシュのキーに使う)
+        for name in names:
+            self.get(name)
+        return hashlib.sha1("\0".join(self.digests[name] for name in names).encode("utf-8")).hexdigest()
+
+    def snapshot(self):
+        return {"version": self.version, "generations": dict(self.generations), "digests": dict(self.digests)}
+
+    def adopt(self, snapshot):
+        # レンダープールのプロセスで親と同じ世代を使う (ファイルは読み直さない)
+        if snapshot["version"] == self.version and snapshot["generations"] == self.generations:
+            return False
+        with self._lock:
+            self.version = snapshot["version"]
+            self.generations = dict(snapshot["generations"])
+            self.digests = dict(snapshot["digests"])
+        return True
+
+    def stats(self):
+        return {
+            "version": self.version,
+            "generations": dict(self.generations),
+            "digests": dict(self.digests),
+            "files": len(self._file_digests),
+            "refreshes": self.refreshes,
+            "rehashed": self.rehashed,
+        }
+
+
+data_version = DataVersion(data_groups)
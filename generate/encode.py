@@ -0,0 +1,132 @@
+import io
+import os
+import sys
+import threading
+import time
+
+from PIL import Image
+
+# format -> Content-Type
+media_types = {
+    "png": "image/png",
+    "png8": "image/png",
+    "webp": "image/webp",
+    "jpeg": "image/jpeg",
+}
+# format -> 拡張子
+image_extensions = {
+    "png": "png",
+    "png8": "png",
+    "webp": "webp",
+    "jpeg": "jpg",
+}
+# Accept が同じ優先度なら前のものを使う (png8 は format 指定のときだけ)
+negotiable_formats = ["png", "webp", "jpeg"]
+
+# Accept で他の形式の q がこれより高いときだけ他の形式にする (ブラウザの Accept では変わらない)
+DEFAULT_IMAGE_FORMAT = os.environ.get("DEFAULT_IMAGE_FORMAT", "png")
+PNG_COMPRESS_LEVEL = int(os.environ.get("PNG_COMPRESS_LEVEL", 3))
+DEFAULT_QUALITY = {"webp": 90, "jpeg": 90}
+
+_local = threading.local()
+
+
+def get_output_buffer():
+    # スレッド (プロセス) ごとに1つのバッファを使い回す
+    buffer = getattr(_local, "buffer", None)
+    if buffer is None:
+        buffer = io.BytesIO()
+        _local.buffer = buffer
+    buffer.seek(0)
+    return buffer
+
+
+def encode_image(img, image_format="png", quality=None):
+    if image_format not in media_types:
+        raise ValueError(f"unsupported format: {image_format}")
+    buffer = get_output_buffer()
+    if image_format == "png":
+        img.save(buffer, "PNG", compress_level=PNG_COMPRESS_LEVEL)
+    elif image_format == "png8":
+        img.quantize(256, method=Image.Quantize.FASTOCTREE).save(buffer, "PNG", compress_level=PNG_COMPRESS_LEVEL)
+    elif image_format == "webp":
+        img.save(buffer, "WEBP", quality=quality or DEFAULT_QUALITY["webp"], method=4)
+    elif image_format == "jpeg":
+        img.convert("RGB").save(buffer, "JPEG", quality=quality or DEFAULT_QUALITY["jpeg"])
+    size = buffer.tell()
+    with buffer.getbuffer() as view:
+        return bytes(view[:size])
+
+
+def negotiate_format(accept, default=DEFAULT_IMAGE_FORMAT):
+    """Pick a format for an Accept header.
+
+    The default is kept unless another of negotiable_formats has a strictly higher q (or the
+    default is not acceptable), so "image/webp,*/*" still gets the default.
+    """
+    if not accept:
+        return default
+    ranges = []
+    for part in accept.split(","):
+        params = part.strip().split(";")
+        media_range = params[0].strip().lower()
+        q = 1.0
+        for param in params[1:]:
+            name, _, value = param.strip().partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        ranges.append((media_range, q))
+
+    def get_q(image_format):
+        media_type = media_types[image_format]
+        # 一番具体的に一致した範囲の q を使う
+        match = None
+        for media_range, q in ranges:
+            if media_range == media_type:
+                specificity = 2
+            elif media_range == media_type.split("/")[0] + "/*":
+                specificity = 1
+            elif media_range == "*/*":
+                specificity = 0
+            else:
+                continue
+            if match is None or specificity > match[1]:
+                match = (q, specificity)
+        return match[0] if match is not None else 0.0
+
+    best = default
+    best_q = get_q(default) if default in media_types else 0.0
+    for image_format in negotiable_formats:
+        q = get_q(image_format)
+        # 同じ q なら既定の形式 (無ければ前のもの) のまま
+        if q > best_q:
+            best, best_q = image_format, q
+    return best
+
+
+def benchmark_encoders(img, repeat=3, formats=None):
+    # 形式ごとのエンコード時間 (ms, 最小値) とサイズ
+    result = {}
+    for image_format in formats or media_types:
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            data = encode_image(img, image_format)
+            times.append((time.perf_counter() - start) * 1000)
+        result[image_format] = {"ms": round(min(times), 1), "bytes": len(data)}
+    start = time.perf_counter()
+    buffer = io.BytesIO()
+    img.save(buffer, "PNG", optimize=True)
+    result["png_optimize"] = {"ms": round((time.perf_counter() - start) * 1000, 1), "bytes": buffer.tell()}
+    return result
+
+
+if __name__ == "__main__":
+    # python -m generate.encode card.png
+    with Image.open(sys.argv[1]) as src:
+        card = src.convert("RGBA")
+    for name, value in benchmark_encoders(card).items():
+        print(f"{name:14} {value['ms']:8.1f} ms {value['bytes']:10d} bytes")
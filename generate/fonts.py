@@ -0,0 +1,86 @@
+import os
+import threading
+
+from PIL import ImageFont
+
+assets_path = f"{os.path.dirname(os.path.abspath(__file__))}/assets"
+default_font_path = f"{assets_path}/zh-cn.ttf"
+# zh-cn.ttf に無い文字がある言語用のフォント (assets に置いてあればその言語のカード全体で使う)
+fallback_font_files = {
+    "th": "th.ttf",
+    "ru": "ru.ttf",
+    "vi": "vi.ttf",
+}
+
+
+def get_rss_bytes():
+    # Linux 以外では測らない
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class FontRegistry:
+    """FreeType faces loaded once per (font file, size) and shared by every render in the process.
+
+    Returned fonts are shared and must not be modified.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        # フェイスを読み込んだときに増えたメモリ (RSS) の合計
+        self.loaded_bytes = 0
+        self._fonts = {}
+        self._lock = threading.Lock()
+
+    def get_font_path(self, lang=None):
+        file_name = fallback_font_files.get(lang)
+        if file_name is not None and os.path.exists(f"{assets_path}/{file_name}"):
+            return f"{assets_path}/{file_name}"
+        return default_font_path
+
+    def get(self, size, lang=None):
+        key = (self.get_font_path(lang), max(1, int(size)))
+        font = self._fonts.get(key)
+        if font is not None:
+            self.hits += 1
+            return font
+        with self._lock:
+            font = self._fonts.get(key)
+            if font is None:
+                self.misses += 1
+                rss = get_rss_bytes()
+                font = ImageFont.truetype(*key)
+                if rss is not None:
+                    self.loaded_bytes += max(0, get_rss_bytes() - rss)
+                self._fonts[key] = font
+            return font
+
+    def preload(self, sizes, langs=None):
+        for lang in [None] + list(langs or fallback_font_files):
+            for size in sizes:
+                self.get(size, lang)
+        return len(self._fonts)
+
+    def clear(self):
+        with self._lock:
+            self._fonts.clear()
+
+    def stats(self):
+        with self._lock:
+            keys = list(self._fonts)
+        paths = sorted({path for path, _ in keys})
+        return {
+            "faces": len(keys),
+            "files": [os.path.basename(path) for path in paths],
+            "file_bytes": sum(os.path.getsize(path) for path in paths),
+            "loaded_bytes": self.loaded_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+font_registry = FontRegistry()
@@ -12,8 +12,13 @@ from generate.templates import one, two
 font_file_path = f"{os.path.dirname(os.path.abspath(__file__))}/assets/zh-cn.ttf"
 
 
-async def generate_panel(uid="805477392", chara_id=1, template=2, is_hideUID=False, calculating_standard="compatibility", lang="jp", is_hide_roll=False):
+async def generate_panel(uid="805477392", chara_id=1, template=2, is_hideUID=False, calculating_standard="compatibility", lang="jp", is_hide_roll=False, image_format="png", quality=None, width=1280, not_modified=None):
     if template == 1:
         return await one.generate_panel(uid=uid, chara_id=chara_id, is_hideUID=is_hideUID, calculating_standard=calculating_standard)
     elif template == 2:
-        return await two.generate_panel(uid=uid, chara_id=chara_id, is_hideUID=is_hideUID, calculating_standard=calculating_standard, lang=lang, is_hide_roll=is_hide_roll)
+        return await two.generate_panel(uid=uid, chara_id=chara_id, is_hideUID=is_hideUID, calculating_standard=calculating_standard, lang=lang, is_hide_roll=is_hide_roll, image_format=image_format, quality=quality, width=width, not_modified=not_modified)
+
+
+async def generate_panels(uid="805477392", chara_ids=None, is_hideUID=False, calculating_standard="compatibility", lang="jp", is_hide_roll=False, image_format="png", quality=None, width=1280):
+    # 複数キャラの一括生成 (テンプレート2のみ)
+    return await two.generate_panels(uid=uid, chara_ids=chara_ids, is_hideUID=is_hideUID, calculating_standard=calculating_standard, lang=lang, is_hide_roll=is_hide_roll, image_format=image_format, quality=quality, width=width)
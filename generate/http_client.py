@@ -0,0 +1,83 @@
+import asyncio
+import os
+
+import aiohttp
+
+HTTP_LIMIT = int(os.environ.get("HTTP_LIMIT", 100))
+HTTP_LIMIT_PER_HOST = int(os.environ.get("HTTP_LIMIT_PER_HOST", 8))
+HTTP_KEEPALIVE_TIMEOUT = float(os.environ.get("HTTP_KEEPALIVE_TIMEOUT", 30))
+HTTP_DNS_CACHE_TTL = int(os.environ.get("HTTP_DNS_CACHE_TTL", 300))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 3))
+HTTP_TOTAL_TIMEOUT = float(os.environ.get("HTTP_TOTAL_TIMEOUT", 10))
+# API ごとのタイムアウト (秒)
+MIHOMO_TIMEOUT = float(os.environ.get("MIHOMO_TIMEOUT", 3))
+ENKA_TIMEOUT = float(os.environ.get("ENKA_TIMEOUT", 7))
+
+session = None
+
+
+class SingleFlight:
+    """Run one call per key at a time; concurrent callers with the same key share its result."""
+
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self._inflight = {}
+
+    def start(self, key, func):
+        # 実行中ならそのタスク、無ければ func() を始めたタスクを返す (待たなくてもよい)
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            return task
+        self.calls += 1
+        task = asyncio.ensure_future(func())
+        self._inflight[key] = task
+        task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return task
+
+    async def do(self, key, func):
+        return await asyncio.shield(self.start(key, func))
+
+    def stats(self):
+        return {"calls": self.calls, "coalesced": self.coalesced, "inflight": len(self._inflight)}
+
+
+# (uid, lang) ごとのプロフィール取得と URL ごとの画像ダウンロード
+profile_flight = SingleFlight()
+image_flight = SingleFlight()
+
+
+def get_session():
+    # startup で作っていなければ (スクリプトから使うときなど) ここで作る
+    global session
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit=HTTP_LIMIT, limit_per_host=HTTP_LIMIT_PER_HOST,
+                                         keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT, ttl_dns_cache=HTTP_DNS_CACHE_TTL)
+        timeout = aiohttp.ClientTimeout(total=HTTP_TOTAL_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+        session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    return session
+
+
+async def start():
+    return get_session()
+
+
+async def close():
+    global session
+    if session is not None and not session.closed:
+        await session.close()
+    session = None
+
+
+def stats():
+    connector = session.connector if session is not None and not session.closed else None
+    return {
+        "open": connector is not None,
+        "limit": HTTP_LIMIT,
+        "limit_per_host": HTTP_LIMIT_PER_HOST,
+        "keepalive_timeout": HTTP_KEEPALIVE_TIMEOUT,
+        "dns_cache_ttl": HTTP_DNS_CACHE_TTL,
+        "profile": profile_flight.stats(),
+        "image": image_flight.stats(),
+    }
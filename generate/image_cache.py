@@ -0,0 +1,83 @@
+import os
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+from generate.sprites import sprite_store
+
+
+def decode_image(path, size=None, crop=None):
+    with Image.open(path) as src:
+        img = src.resize(size) if size is not None else src.copy()
+    if crop is not None:
+        img = img.crop(crop)
+    if img.mode != "RGBA":
+        img = img.convert("RGBA")
+    return img
+
+
+class ImageCache:
+    """Decoded RGBA images keyed by (path, digest, size, crop), evicted LRU by byte budget.
+
+    digest is the sha1 of the file from the asset mirror manifest, so an image whose content
+    changed is loaded again while the others stay cached. Returned images are shared between
+    renders and must not be modified in place.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path, size=None, crop=None, sprite_namespace=None, digest=None):
+        # sprite_namespace を指定すると、縮小・切り抜き済みの画像をディスクにも置く (digest が分かるときだけ)
+        key = (path, digest, size, crop)
+        with self._lock:
+            img = self._images.get(key)
+            if img is not None:
+                self._images.move_to_end(key)
+                self.hits += 1
+                return img
+            self.misses += 1
+
+        use_sprite = sprite_namespace is not None and digest is not None and size is not None and sprite_store.enabled
+        img = sprite_store.load(sprite_namespace, digest, size, crop) if use_sprite else None
+        if img is None:
+            img = decode_image(path, size, crop)
+            if use_sprite:
+                sprite_store.save(sprite_namespace, digest, size, crop, img)
+
+        nbytes = img.width * img.height * 4
+        with self._lock:
+            if key not in self._images and nbytes <= self.max_bytes:
+                self._images[key] = img
+                self.current_bytes += nbytes
+                while self.current_bytes > self.max_bytes:
+                    _, old = self._images.popitem(last=False)
+                    self.current_bytes -= old.width * old.height * 4
+                    self.evictions += 1
+        return img
+
+    def clear(self):
+        with self._lock:
+            self._images.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._images),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+image_cache = ImageCache(int(os.environ.get("IMAGE_CACHE_MAX_BYTES", 128 * 1024 * 1024)))
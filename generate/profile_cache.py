@@ -0,0 +1,160 @@
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+PROFILE_CACHE_MAX_ENTRIES = int(os.environ.get("PROFILE_CACHE_MAX_ENTRIES", 10000))
+PROFILE_CACHE_MAX_BYTES = int(os.environ.get("PROFILE_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+# この秒数のあいだは取り直さない (以前の１分のインターバル)
+PROFILE_CACHE_TTL = float(os.environ.get("PROFILE_CACHE_TTL", 60))
+# TTL を過ぎてからこの秒数のあいだは、裏で取り直しつつ古いプロフィールを返す
+PROFILE_CACHE_STALE_TTL = float(os.environ.get("PROFILE_CACHE_STALE_TTL", 600))
+
+
+def get_result_size(result):
+    # メモリ上の大きさの目安として JSON にしたときのサイズを使う
+    return len(json.dumps(result, ensure_ascii=False, separators=(',', ':')).encode("utf-8"))
+
+
+class ProfileEntry:
+    __slots__ = ("result", "fetched_at", "fresh_until", "stale_until", "refresh_after", "size")
+
+    def __init__(self, result, fetched_at, fresh_until, stale_until, size):
+        self.result = result
+        self.fetched_at = fetched_at
+        self.fresh_until = fresh_until
+        self.stale_until = stale_until
+        self.refresh_after = fresh_until
+        self.size = size
+
+
+class ProfileCache:
+    """sr_info_parsed payloads keyed by (uid, lang), evicted LRU by entry count and byte budget.
+
+    Entries are fresh for ttl seconds and may then be served stale for stale_ttl more seconds
+    while a refresh runs. Expired entries are dropped through a heap ordered by expiry time.
+    Error payloads ("detail") are cached for ttl only and never replace a good stale profile.
+    """
+
+    def __init__(self, max_entries, max_bytes, ttl, stale_ttl):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.current_bytes = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()
+        # (stale_until, 連番, key)。差し替えられた古い項目は取り出したときに無視する
+        self._expiry = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.current_bytes -= entry.size
+        return entry
+
+    def _expire(self, now):
+        while self._expiry and self._expiry[0][0] <= now:
+            stale_until, _, key = heapq.heappop(self._expiry)
+            entry = self._entries.get(key)
+            if entry is not None and entry.stale_until == stale_until:
+                self._remove(key)
+                self.expirations += 1
+
+    def expire(self):
+        with self._lock:
+            self._expire(time.time())
+
+    def get(self, key):
+        """Return (result, "fresh" | "stale") or (None, None)."""
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None, None
+            self._entries.move_to_end(key)
+            if now < entry.fresh_until:
+                self.hits += 1
+                return entry.result, "fresh"
+            self.stale_hits += 1
+            return entry.result, "stale"
+
+    def should_refresh(self, key):
+        # 古いプロフィールを返すときに裏で取り直すか (ttl に1回まで)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or now < entry.refresh_after:
+                return False
+            entry.refresh_after = now + self.ttl
+            return True
+
+    def put(self, key, result, fetched_at=None, stale=False):
+        # stale: ディスクから読んだものなど、すぐに取り直すべきプロフィール
+        now = time.time()
+        fetched_at = fetched_at or now
+        is_error = "detail" in result
+        size = get_result_size(result)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._expire(now)
+            old = self._entries.get(key)
+            if is_error and old is not None and "detail" not in old.result:
+                return
+            if old is not None:
+                self._remove(key)
+            if stale:
+                fresh_until = now
+                stale_until = now + self.stale_ttl
+            else:
+                fresh_until = fetched_at + self.ttl
+                stale_until = fresh_until if is_error else fresh_until + self.stale_ttl
+            if stale_until <= now:
+                return
+            self._entries[key] = ProfileEntry(result, fetched_at, fresh_until, stale_until, size)
+            self.current_bytes += size
+            heapq.heappush(self._expiry, (stale_until, next(self._counter), key))
+            while len(self._entries) > self.max_entries or self.current_bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+            # 差し替えで無効になった項目がたまりすぎたら作り直す
+            if len(self._expiry) > 2 * len(self._entries) + 64:
+                self._expiry = [(entry.stale_until, next(self._counter), k) for k, entry in self._entries.items()]
+                heapq.heapify(self._expiry)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._expiry.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "stale_ttl": self.stale_ttl,
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+profile_cache = ProfileCache(PROFILE_CACHE_MAX_ENTRIES, PROFILE_CACHE_MAX_BYTES,
+                             PROFILE_CACHE_TTL, PROFILE_CACHE_STALE_TTL)
@@ -0,0 +1,84 @@
+import os
+import sqlite3
+import threading
+import time
+
+import msgspec
+
+# 設定したときだけプロフィールをディスクにも保存する (再起動後もすぐに返せるように)
+PROFILE_DB_PATH = os.environ.get("PROFILE_DB_PATH", "")
+# これより古いプロフィールは使わない (秒)
+PROFILE_DB_MAX_AGE = float(os.environ.get("PROFILE_DB_MAX_AGE", 24 * 60 * 60))
+
+
+class ProfileStore:
+    """sr_info_parsed payloads keyed by (uid, lang), stored as msgpack in SQLite with their fetch time."""
+
+    def __init__(self, path, max_age):
+        self.path = path
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self._conn = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def _connect(self):
+        if self._conn is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS profiles (uid TEXT NOT NULL, lang TEXT NOT NULL, "
+                         "fetched_at REAL NOT NULL, payload BLOB NOT NULL, PRIMARY KEY (uid, lang)) WITHOUT ROWID")
+            conn.execute("CREATE INDEX IF NOT EXISTS profiles_fetched_at ON profiles (fetched_at)")
+            self._conn = conn
+        return self._conn
+
+    def load(self, key):
+        """Return (result, fetched_at) for key, or (None, None) when missing or older than max_age."""
+        uid, lang = key
+        with self._lock:
+            row = self._connect().execute("SELECT fetched_at, payload FROM profiles WHERE uid = ? AND lang = ?",
+                                          (uid, lang)).fetchone()
+        if row is None or row[0] < time.time() - self.max_age:
+            self.misses += 1
+            return None, None
+        self.hits += 1
+        return msgspec.msgpack.decode(row[1]), row[0]
+
+    def save(self, key, result, fetched_at):
+        uid, lang = key
+        payload = msgspec.msgpack.encode(result)
+        with self._lock:
+            self._connect().execute("INSERT OR REPLACE INTO profiles (uid, lang, fetched_at, payload) "
+                                    "VALUES (?, ?, ?, ?)", (uid, lang, fetched_at, payload))
+            self.writes += 1
+
+    def prune(self):
+        with self._lock:
+            return self._connect().execute("DELETE FROM profiles WHERE fetched_at < ?",
+                                           (time.time() - self.max_age,)).rowcount
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "max_age": self.max_age,
+            "hits": self.hits,
+            "misses": self.misses,
+            "writes": self.writes,
+        }
+
+
+profile_store = ProfileStore(PROFILE_DB_PATH, PROFILE_DB_MAX_AGE)
@@ -0,0 +1,133 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# "process" or "thread"
+RENDER_EXECUTOR = os.environ.get("RENDER_EXECUTOR", "process")
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", 2))
+# 実行中の分を除いて待機できるジョブ数
+RENDER_QUEUE_SIZE = int(os.environ.get("RENDER_QUEUE_SIZE", 16))
+
+executor = None
+# start() の引数 (作り直すときにも同じものを使う)
+executor_initializer = None
+executor_initargs = ()
+restart_lock = threading.Lock()
+pending = 0
+render_stats = {
+    "jobs": 0,
+    "errors": 0,
+    "rejected": 0,
+    "restarts": 0,
+    "render_ms_total": 0.0,
+    "render_ms_max": 0.0,
+    "wait_ms_total": 0.0,
+    "wait_ms_max": 0.0,
+}
+
+
+class RenderQueueFull(Exception):
+    pass
+
+
+def start(initializer=None, initargs=(), mp_context=None):
+    """Create the pool; initializer(*initargs) runs once in every worker (e.g. to preload fonts)."""
+    global executor, executor_initializer, executor_initargs
+    if executor is not None:
+        return executor
+    if initializer is not None:
+        executor_initializer, executor_initargs = initializer, initargs
+    if RENDER_EXECUTOR == "thread":
+        executor = ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix="render",
+                                      initializer=executor_initializer, initargs=executor_initargs)
+    else:
+        executor = ProcessPoolExecutor(max_workers=RENDER_WORKERS, mp_context=mp_context,
+                                       initializer=executor_initializer, initargs=executor_initargs)
+        # 最初の submit まではプロセスが作られないので、ここで全部作っておく
+        # (スレッドがロックを持ったまま fork されると、そのプロセスは固まる)
+        executor.submit(os.getpid).result()
+    return executor
+
+
+def restart(broken):
+    """Replace a broken pool (a worker was killed, e.g. by the OOM killer) with a new one."""
+    global executor
+    # 同時に壊れたのを知ったジョブが何度も作り直さないように
+    with restart_lock:
+        if executor is broken:
+            executor = None
+            broken.shutdown(wait=False, cancel_futures=True)
+            render_stats["restarts"] += 1
+            print("render pool broken, restarting")
+            # 起動後はスレッドが動いているので fork せず forkserver から作る
+            return start(mp_context=multiprocessing.get_context("forkserver"))
+        return start()
+
+
+def shutdown():
+    global executor
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+        executor = None
+
+
+def _run_job(func, args):
+    started_at = time.time()
+    start_counter = time.perf_counter()
+    result = func(*args)
+    return result, started_at, (time.perf_counter() - start_counter) * 1000
+
+
+async def submit(func, *args):
+    """Run func(*args) on the render pool. func and args must be picklable in process mode."""
+    global pending
+    if pending >= RENDER_WORKERS + RENDER_QUEUE_SIZE:
+        render_stats["rejected"] += 1
+        raise RenderQueueFull()
+    pending += 1
+    queued_at = time.time()
+    try:
+        pool = start()
+        try:
+            result, started_at, render_ms = await asyncio.get_running_loop().run_in_executor(pool, _run_job, func, args)
+        except BrokenProcessPool:
+            # 壊れたプールは使い続けずに作り直す (落とした本人のジョブはやり直さない)
+            await asyncio.to_thread(restart, pool)
+            raise
+    except Exception:
+        render_stats["errors"] += 1
+        raise
+    finally:
+        pending -= 1
+    wait_ms = max(0.0, (started_at - queued_at) * 1000)
+    render_stats["jobs"] += 1
+    render_stats["render_ms_total"] += render_ms
+    render_stats["render_ms_max"] = max(render_stats["render_ms_max"], render_ms)
+    render_stats["wait_ms_total"] += wait_ms
+    render_stats["wait_ms_max"] = max(render_stats["wait_ms_max"], wait_ms)
+    if isinstance(result, dict):
+        result["render_ms"] = round(render_ms, 1)
+        result["wait_ms"] = round(wait_ms, 1)
+    return result
+
+
+def stats():
+    jobs = render_stats["jobs"]
+    return {
+        "executor": RENDER_EXECUTOR,
+        "workers": RENDER_WORKERS,
+        "queue_size": RENDER_QUEUE_SIZE,
+        "pending": pending,
+        "jobs": jobs,
+        "errors": render_stats["errors"],
+        "rejected": render_stats["rejected"],
+        "restarts": render_stats["restarts"],
+        "render_ms_avg": round(render_stats["render_ms_total"] / jobs, 1) if jobs else 0.0,
+        "render_ms_max": round(render_stats["render_ms_max"], 1),
+        "wait_ms_avg": round(render_stats["wait_ms_total"] / jobs, 1) if jobs else 0.0,
+        "wait_ms_max": round(render_stats["wait_ms_max"], 1),
+    }
@@ -0,0 +1,63 @@
+import pathlib
+import threading
+
+from starrailres import Index
+
+from generate.data_version import data_version, res_path
+
+
+class IndexCache:
+    """One starrailres Index per language, shared until the index_min data version changes."""
+
+    def __init__(self):
+        self.generation = None
+        self.builds = 0
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def get(self, lang):
+        if self.generation != data_version.get("res_index"):
+            self.reload()
+        index = self._indexes.get(lang)
+        if index is not None:
+            return index
+        with self._lock:
+            index = self._indexes.get(lang)
+            if index is None:
+                # index_min/{lang} の JSON をまとめて読むので重い (言語ごとに1回だけ)
+                index = Index(pathlib.Path(f"{res_path}/index_min/{lang}"))
+                self._indexes[lang] = index
+                self.builds += 1
+            return index
+
+    def reload(self):
+        # 使っている言語を新しいデータで作り直してから差し替える (その間は古い Index を返す)
+        generation = data_version.get("res_index")
+        if generation == self.generation:
+            return False
+        indexes = {}
+        for lang in list(self._indexes):
+            try:
+                indexes[lang] = Index(pathlib.Path(f"{res_path}/index_min/{lang}"))
+            except Exception as e:
+                print(f"res index {lang} failed")
+                print(repr(e))
+        with self._lock:
+            self._indexes = indexes
+            self.generation = generation
+            self.builds += len(indexes)
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._indexes.clear()
+
+    def stats(self):
+        return {
+            "langs": sorted(self._indexes),
+            "builds": self.builds,
+            "generation": self.generation,
+        }
+
+
+index_cache = IndexCache()
@@ -0,0 +1,145 @@
+import bisect
+import json
+import os
+import sys
+import threading
+import time
+
+from generate.data_version import data_version
+
+rolls_json_path = f"{os.path.dirname(os.path.abspath(__file__))}/rolls.json"
+
+
+class RollTable:
+    """All low/mid/high roll combinations of one (stat type, rarity), sorted by their value."""
+
+    def __init__(self, rarity, low, mid, high):
+        entries = []
+        # 旧 get_rolls と同じ順番で列挙し、同じ誤差のときは先に見つかった組み合わせを優先する
+        for i in range(rarity + 1):
+            for j in range(rarity + 1):
+                for k in range(rarity + 1):
+                    if i + j + k > rarity + 1:
+                        break
+                    entries.append((i * low + j * mid + k * high, len(entries), (i, j, k)))
+        entries.sort()
+        self.sums = [entry[0] for entry in entries]
+        self.orders = [entry[1] for entry in entries]
+        self.combos = [entry[2] for entry in entries]
+
+    def lookup(self, value):
+        sums = self.sums
+        pos = bisect.bisect_left(sums, value)
+        candidates = []
+        # 値に一番近い左右の組み合わせと、それと誤差が同じものを候補にする
+        if pos > 0:
+            margin = abs(sums[pos - 1] - value)
+            n = pos - 1
+            while n >= 0 and abs(sums[n] - value) == margin:
+                candidates.append((margin, self.orders[n], n))
+                n -= 1
+        if pos < len(sums):
+            margin = abs(sums[pos] - value)
+            n = pos
+            while n < len(sums) and abs(sums[n] - value) == margin:
+                candidates.append((margin, self.orders[n], n))
+                n += 1
+        if not candidates:
+            return None
+        margin, _, n = min(candidates)
+        if not margin < 100:
+            return None
+        return list(self.combos[n])
+
+
+def load_roll_tables():
+    with open(rolls_json_path) as f:
+        rolls_json = json.load(f)
+    tables = {}
+    for stat_type, rarities in rolls_json.items():
+        for rarity, (low, mid, high) in rarities.items():
+            tables[(stat_type, int(rarity))] = RollTable(int(rarity), low, mid, high)
+    return tables
+
+
+roll_tables = None
+roll_tables_generation = None
+roll_tables_lock = threading.Lock()
+
+
+def get_roll_tables():
+    # rolls.json の世代が変わったら作り直す
+    global roll_tables, roll_tables_generation
+    generation = data_version.get("rolls")
+    if roll_tables_generation != generation:
+        with roll_tables_lock:
+            if roll_tables_generation != generation:
+                roll_tables = load_roll_tables()
+                roll_tables_generation = generation
+    return roll_tables
+
+
+def get_rolls(rarity, stats):
+    # サブステータスの値を [低, 中, 高] の伸び回数に分解する
+    return get_roll_tables()[(stats["type"], int(rarity))].lookup(stats["value"])
+
+
+def get_character_rolls(helta_json):
+    # 全遺物のサブステータスをまとめて分解する [[遺物1のサブ1, ...], ...]
+    return [[get_rolls(relic["rarity"], sub_i) for sub_i in relic["sub_affix"]]
+            for relic in helta_json["relics"]]
+
+
+def find_rolls(rarity, stats):
+    # 旧 get_rolls そのまま (呼ぶたびに rolls.json を読んで全部の組み合わせを試す)。比較用
+    with open(rolls_json_path) as f:
+        rolls_json = json.load(f)
+    low, mid, high = rolls_json[stats["type"]][str(rarity)]
+    value = stats["value"]
+    result = None
+    max_margin = 100
+    for i in range(rarity + 1):
+        for j in range(rarity + 1):
+            for k in range(rarity + 1):
+                if i + j + k > rarity + 1:
+                    break
+                value_sum = i * low + j * mid + k * high
+                if abs(value_sum - value) < max_margin:
+                    max_margin = abs(value_sum - value)
+                    result = [i, j, k]
+    return result
+
+
+def benchmark_rolls(cases, repeat=3):
+    """Time find_rolls and get_rolls (us per call, best of repeat) and count differing results."""
+    get_roll_tables()
+    result = {"cases": len(cases),
+              "mismatches": sum(1 for rarity, stats in cases if find_rolls(rarity, stats) != get_rolls(rarity, stats))}
+    for name, func in (("find_rolls", find_rolls), ("get_rolls", get_rolls)):
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for rarity, stats in cases:
+                func(rarity, stats)
+            times.append(time.perf_counter() - start)
+        result[name] = round(min(times) / max(len(cases), 1) * 1e6, 2)
+    return result
+
+
+if __name__ == "__main__":
+    # python -m generate.rolls [profile.json] (無ければ全ての組み合わせの値とその中間で測る)
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], encoding="utf-8") as f:
+            cases = [(relic["rarity"], sub_affix) for character in json.load(f)["characters"]
+                     for relic in character["relics"] for sub_affix in relic["sub_affix"]]
+    else:
+        cases = []
+        for (stat_type, rarity), table in get_roll_tables().items():
+            values = table.sums + [(a + b) / 2 for a, b in zip(table.sums, table.sums[1:])]
+            cases += [(rarity, {"type": stat_type, "value": value}) for value in values]
+    result = benchmark_rolls(cases)
+    print(f"cases       {result['cases']:8d}")
+    print(f"mismatches  {result['mismatches']:8d}")
+    print(f"find_rolls  {result['find_rolls']:8.2f} us")
+    print(f"get_rolls   {result['get_rolls']:8.2f} us")
+    sys.exit(1 if result["mismatches"] else 0)
@@ -0,0 +1,252 @@
+import bisect
+import datetime
+import json
+import math
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+scores_path = f"{os.path.dirname(os.path.abspath(__file__))}/scores"
+db_path = os.environ.get("SCORE_DB_PATH", f"{scores_path}/scores.sqlite3")
+# メモリに読み込んでおくスコアの数の上限 (超えたら使われていないボードから捨てる)
+SCORE_BOARD_MAX_ROWS = int(os.environ.get("SCORE_BOARD_MAX_ROWS", 500000))
+
+
+def get_board_name(chara_id, calculation_value="compatibility"):
+    # 旧 scores/{board}.json のファイル名と同じ
+    if calculation_value != "compatibility" and calculation_value != "no_score":
+        return f"{chara_id}_{calculation_value}"
+    return f"{chara_id}"
+
+
+class ScoreBoard:
+    """Best score per uid of one board, with the scores kept sorted for bisect lookups."""
+
+    def __init__(self, rows, version=0):
+        self.scores = dict(rows)
+        # 読み込んだときの boards.version (違っていれば他のプロセスが書き込んでいる)
+        self.version = version
+        # 降順で扱うため符号を反転して昇順に保持
+        self.negated = sorted(-score for score in self.scores.values())
+        # 足し引きを繰り返しても誤差が溜まらないように、合計は 0.1 単位の整数で持つ (スコアは小数1桁)
+        self.total_tenths = sum(round(score * 10) for score in self.scores.values())
+
+    def __len__(self):
+        return len(self.negated)
+
+    def set(self, uid, score):
+        old = self.scores.get(uid)
+        if old is not None:
+            del self.negated[bisect.bisect_left(self.negated, -old)]
+            self.total_tenths -= round(old * 10)
+        self.scores[uid] = score
+        bisect.insort(self.negated, -score)
+        self.total_tenths += round(score * 10)
+
+    def count_above(self, score):
+        return bisect.bisect_left(self.negated, -score)
+
+    def median(self):
+        n = len(self.negated)
+        if n == 0:
+            return math.nan
+        if n % 2 == 1:
+            return -self.negated[n // 2]
+        return (-self.negated[n // 2 - 1] - self.negated[n // 2]) / 2
+
+    def mean(self):
+        if not self.negated:
+            return math.nan
+        return self.total_tenths / len(self.negated) / 10
+
+
+class ScoreStore:
+    """Best scores per board in SQLite, with recently used boards loaded as ScoreBoard.
+
+    Every write bumps boards.version, so a board written by another process is read again
+    before it is ranked against. Loaded boards are evicted LRU once they hold more than
+    max_rows scores.
+    """
+
+    def __init__(self, path, max_rows):
+        self.path = path
+        self.max_rows = max_rows
+        self.loaded_rows = 0
+        self.loads = 0
+        self.reloads = 0
+        self.evictions = 0
+        self._conn = None
+        self._boards = OrderedDict()
+        # ボード -> (登録数, 更新日時)。rebuild_counts() するまでは None
+        self._counts = None
+        self.counts_rebuilt_at = None
+        self._lock = threading.RLock()
+
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS scores (board TEXT NOT NULL, uid TEXT NOT NULL, "
+                         "score REAL NOT NULL, PRIMARY KEY (board, uid)) WITHOUT ROWID")
+            conn.execute("CREATE TABLE IF NOT EXISTS boards (board TEXT PRIMARY KEY, "
+                         "version INTEGER NOT NULL DEFAULT 0)")
+            if "version" not in [row[1] for row in conn.execute("PRAGMA table_info(boards)")]:
+                try:
+                    conn.execute("ALTER TABLE boards ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+                except sqlite3.OperationalError:
+                    # 他のプロセスが先に追加した
+                    pass
+            self._conn = conn
+        return self._conn
+
+    def _ensure_imported(self, board):
+        # 未移行の scores/{board}.json があれば取り込む
+        conn = self._connect()
+        if conn.execute("SELECT 1 FROM boards WHERE board = ?", (board,)).fetchone():
+            return
+        rows = []
+        json_path = f"{scores_path}/{board}.json"
+        if os.path.exists(json_path):
+            with open(json_path) as f:
+                score_json = json.load(f).get("score", {})
+            for uid, score in score_json.items():
+                if score is None:
+                    continue
+                rows.append((board, uid[:-1] if uid.endswith("u") else uid, float(score)))
+        # 他のプロセスが同時に取り込むことがあるので、書き込みロックを取ってから確かめ直す
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if conn.execute("SELECT 1 FROM boards WHERE board = ?", (board,)).fetchone():
+                return
+            conn.executemany("INSERT INTO scores (board, uid, score) VALUES (?, ?, ?) "
+                             "ON CONFLICT (board, uid) DO UPDATE SET score = excluded.score "
+                             "WHERE excluded.score > scores.score", rows)
+            conn.execute("INSERT OR IGNORE INTO boards (board) VALUES (?)", (board,))
+
+    def _get_version(self, board):
+        row = self._connect().execute("SELECT version FROM boards WHERE board = ?", (board,)).fetchone()
+        return row[0] if row is not None else None
+
+    def _get_board(self, board):
+        version = self._get_version(board)
+        score_board = self._boards.get(board)
+        if score_board is not None and score_board.version == version:
+            self._boards.move_to_end(board)
+            return score_board
+        if version is None:
+            self._ensure_imported(board)
+            version = self._get_version(board)
+        if score_board is not None:
+            self.reloads += 1
+            self.loaded_rows -= len(self._boards.pop(board))
+        # 版を読んでから行を読む (間に書き込まれても次に読み直すだけ)
+        rows = self._connect().execute("SELECT uid, score FROM scores WHERE board = ?", (board,)).fetchall()
+        score_board = ScoreBoard(rows, version)
+        self.loads += 1
+        self._boards[board] = score_board
+        self.loaded_rows += len(score_board)
+        self._evict()
+        return score_board
+
+    def _evict(self):
+        # 今使うボードは最後にあるので捨てない
+        while self.loaded_rows > self.max_rows and len(self._boards) > 1:
+            _, old = self._boards.popitem(last=False)
+            self.loaded_rows -= len(old)
+            self.evictions += 1
+
+    def record(self, board, uid, score):
+        """Keep the best score of uid.
+
+        Returns (previous best or None, rank of score, count, median, mean) of the board.
+        """
+        uid = str(uid)
+        with self._lock:
+            score_board = self._get_board(board)
+            before_score = score_board.scores.get(uid)
+            if before_score is None or score > before_score:
+                conn = self._connect()
+                with conn:
+                    conn.execute("BEGIN IMMEDIATE")
+                    conn.execute(
+                        "INSERT INTO scores (board, uid, score) VALUES (?, ?, ?) "
+                        "ON CONFLICT (board, uid) DO UPDATE SET score = excluded.score "
+                        "WHERE excluded.score > scores.score", (board, uid, float(score)))
+                    conn.execute("UPDATE boards SET version = version + 1 WHERE board = ?", (board,))
+                    version = self._get_version(board)
+                score_board.set(uid, float(score))
+                # 他のプロセスの書き込みが間にあれば版を進めずに、次に読み直す
+                if version == score_board.version + 1:
+                    score_board.version = version
+                if before_score is None:
+                    self.loaded_rows += 1
+                    self._evict()
+                    if self._counts is not None:
+                        self._counts[board] = (len(score_board), datetime.datetime.now())
+            # 順位は今回のスコアで数える (自分のベストが上なら自分自身は除く)
+            above = score_board.count_above(score)
+            if score_board.scores[uid] > score:
+                above -= 1
+            return before_score, above + 1, len(score_board), score_board.median(), score_board.mean()
+
+    def rebuild_counts(self):
+        # 全ボードの登録数を数え直す (起動時に1回)
+        with self._lock:
+            self.import_json()
+            rows = self._connect().execute("SELECT board, COUNT(*) FROM scores GROUP BY board").fetchall()
+            now = datetime.datetime.now()
+            self._counts = {board: (count, now) for board, count in rows}
+            self.counts_rebuilt_at = now
+            return len(self._counts)
+
+    def get_count(self, board):
+        """Return (count, time the count last changed or was rebuilt) of the board."""
+        with self._lock:
+            if self._counts is not None:
+                return self._counts.get(board, (0, self.counts_rebuilt_at))
+            return self.count(board), None
+
+    def count(self, board):
+        with self._lock:
+            if self._counts is not None:
+                return self._counts.get(board, (0, None))[0]
+            self._ensure_imported(board)
+            return self._connect().execute("SELECT COUNT(*) FROM scores WHERE board = ?", (board,)).fetchone()[0]
+
+    def import_json(self):
+        # scores/*.json をまとめて移行する
+        with self._lock:
+            for file_name in sorted(os.listdir(scores_path)):
+                if file_name.endswith(".json"):
+                    self._ensure_imported(file_name[:-5])
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+            self._boards.clear()
+            self.loaded_rows = 0
+            self._counts = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "boards": len(self._boards),
+                "rows": self.loaded_rows,
+                "max_rows": self.max_rows,
+                "loads": self.loads,
+                "reloads": self.reloads,
+                "evictions": self.evictions,
+                "counts": len(self._counts) if self._counts is not None else None,
+            }
+
+
+score_store = ScoreStore(db_path, SCORE_BOARD_MAX_ROWS)
+
+
+if __name__ == "__main__":
+    score_store.import_json()
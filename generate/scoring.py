@@ -0,0 +1,256 @@
+import json
+import sys
+import threading
+import time
+
+import numpy as np
+
+from generate.weights import weight_registry
+
+
+class CompiledWeights:
+    """score.json の重みを配列にまとめたもの (weight_registry の version ごとに作り直す)"""
+
+    def __init__(self, weight_data):
+        self.version = weight_data.version
+        self.weight_data = weight_data
+        self.stat_types = list(weight_data.max.keys())
+        self.stat_index = {t: n for n, t in enumerate(self.stat_types)}
+        self.max = np.array([weight_data.max[t] for t in self.stat_types], dtype=np.float64)
+
+        self.keys = list(weight_data.characters.keys())
+        self.key_index = {k: n for n, k in enumerate(self.keys)}
+        # キャラ ID -> その ID の全ての計算基準 ("1005", "1005_xxx", ...)
+        self.standards = {}
+        for key in self.keys:
+            self.standards.setdefault(key.split("_")[0], []).append(key)
+
+        main_types = []
+        for character_weight in weight_data.characters.values():
+            for slot_weight in character_weight.main.values():
+                for main_type in slot_weight:
+                    if main_type not in main_types:
+                        main_types.append(main_type)
+        self.main_index = {t: n for n, t in enumerate(main_types)}
+
+        # 計算式の表示用 (get_relic_score の f-string と同じ表記)
+        self.sub_weight_texts = [{t: f'{round(v, 1)}' for t, v in character_weight.weight.items()}
+                                 for character_weight in weight_data.characters.values()]
+        self.main_weight_texts = [{(slot[-1], t): f'{v}' for slot, slot_weight in character_weight.main.items()
+                                   for t, v in slot_weight.items()}
+                                  for character_weight in weight_data.characters.values()]
+
+        # 重みが無いものは NaN (get_relic_score では KeyError になる組み合わせ)
+        self.sub_weights = np.full((len(self.keys), len(self.stat_types)), np.nan)
+        self.main_weights = np.full((len(self.keys), 7, len(main_types)), np.nan)
+        for n, character_weight in enumerate(weight_data.characters.values()):
+            for stat_type, value in character_weight.weight.items():
+                if stat_type in self.stat_index:
+                    self.sub_weights[n, self.stat_index[stat_type]] = value
+            for slot, slot_weight in character_weight.main.items():
+                if not slot[-1].isdigit() or not 0 < int(slot[-1]) <= 6:
+                    continue
+                for main_type, value in slot_weight.items():
+                    self.main_weights[n, int(slot[-1]), self.main_index[main_type]] = value
+
+
+_compiled = None
+_compiled_lock = threading.Lock()
+
+
+def get_compiled_weights():
+    global _compiled
+    weight_data = weight_registry.data
+    compiled = _compiled
+    if compiled is None or compiled.version != weight_data.version:
+        with _compiled_lock:
+            if _compiled is None or _compiled.version != weight_data.version:
+                _compiled = CompiledWeights(weight_data)
+            compiled = _compiled
+    return compiled
+
+
+def get_standards(chara_id, compiled=None):
+    compiled = compiled or get_compiled_weights()
+    return list(compiled.standards.get(str(chara_id).split("_")[0], []))
+
+
+def _relic_arrays(compiled, relics):
+    count = len(relics)
+    width = max((len(relic["sub_affix"]) for relic in relics), default=0)
+    values = np.zeros((count, width))
+    indexes = np.zeros((count, width), dtype=np.intp)
+    mask = np.zeros((count, width), dtype=bool)
+    slots = np.zeros(count, dtype=np.intp)
+    main_indexes = np.zeros(count, dtype=np.intp)
+    main_known = np.ones(count, dtype=bool)
+    levels = np.zeros(count)
+    relic_id = compiled.weight_data.relic_id
+    for r, relic in enumerate(relics):
+        for s, sub_affix_json in enumerate(relic["sub_affix"]):
+            values[r, s] = sub_affix_json["value"]
+            indexes[r, s] = compiled.stat_index[sub_affix_json["type"]]
+            mask[r, s] = True
+        slot = relic_id.get(relic["id"], relic["id"])[-1]
+        slots[r] = int(slot) if slot.isdigit() else 0
+        main_type = relic["main_affix"]["type"]
+        if main_type in compiled.main_index:
+            main_indexes[r] = compiled.main_index[main_type]
+        else:
+            main_known[r] = False
+        levels[r] = relic["level"]
+    return values, indexes, mask, slots, main_indexes, main_known, levels
+
+
+def score_matrix(keys, relics, compiled=None):
+    """Score every relic against every weight key.
+
+    Returns (scores, main_scores, ratios). scores has shape (len(keys), len(relics)) and holds
+    the same values as get_relic_score(key, relic)["score"], with NaN where get_relic_score
+    would raise for a missing weight. main_scores are the main affix parts and ratios the
+    per-substat value / max ratios.
+    """
+    compiled = compiled or get_compiled_weights()
+    rows = np.array([compiled.key_index[key] for key in keys], dtype=np.intp)
+    values, indexes, mask, slots, main_indexes, main_known, levels = _relic_arrays(compiled, relics)
+
+    ratios = values / compiled.max[indexes]
+    # (keys, relics, subs)
+    terms = ratios[np.newaxis, :, :] * compiled.sub_weights[rows][:, indexes]
+    # get_relic_score と同じ順番で足す
+    sub_scores = np.zeros((len(rows), len(relics)))
+    for s in range(values.shape[1]):
+        sub_scores += np.where(mask[:, s], terms[:, :, s], 0.0)
+
+    main_weights = compiled.main_weights[rows][:, slots, main_indexes]
+    main_weights[:, ~main_known] = np.nan
+    main_scores = ((levels + 1) / 16)[np.newaxis, :] * main_weights
+    return main_scores * 0.5 + sub_scores * 0.5, main_scores, ratios
+
+
+def score_characters(characters, standards=None):
+    """Batch version of get_relic_score for many characters and calculation standards.
+
+    Returns a list aligned with characters, each {weight key: [get_relic_score(key, relic) for
+    each relic]}, so the same character may appear more than once. Every standard of each
+    character is scored when standards is None. A key whose weights lack a stat used by the
+    relics maps to None. All relics are scored in a single matrix.
+    """
+    compiled = get_compiled_weights()
+    character_keys = []
+    for character in characters:
+        keys = standards if standards is not None else get_standards(character["id"], compiled)
+        character_keys.append([key for key in keys if key in compiled.key_index])
+    all_keys = list(dict.fromkeys(key for keys in character_keys for key in keys))
+    all_relics = [relic for character in characters for relic in character["relics"]]
+
+    if not all_keys or not all_relics:
+        return [{key: [] for key in keys} for keys in character_keys]
+
+    scores, main_scores, ratios = score_matrix(all_keys, all_relics, compiled)
+    scores = scores.tolist()
+    main_scores = (main_scores * 100).tolist()
+    ratio_texts = [[f'{round(ratio * 100, 1)}' for ratio in row] for row in ratios.tolist()]
+    relic_id = compiled.weight_data.relic_id
+
+    result = []
+    start = 0
+    for character, keys in zip(characters, character_keys):
+        relics = character["relics"]
+        slots = [relic_id.get(relic["id"], relic["id"])[-1] for relic in relics]
+        level_texts = [f'{round((relic["level"] + 1) / 16 * 100, 1)}' for relic in relics]
+        character_result = {}
+        for key in keys:
+            k = all_keys.index(key)
+            n = compiled.key_index[key]
+            name = compiled.weight_data.characters[key].name
+            sub_weight_texts = compiled.sub_weight_texts[n]
+            main_weight_texts = compiled.main_weight_texts[n]
+            relic_results = []
+            for r, relic in enumerate(relics):
+                score = scores[k][start + r]
+                if score != score:
+                    relic_results = None
+                    break
+                relic_result = {
+                    "main_formula": f'{level_texts[r]}×{main_weight_texts[(slots[r], relic["main_affix"]["type"])]}'
+                                    f'={main_scores[k][start + r]}',
+                    "score": score,
+                    "sub_formulas": [f'{ratio_texts[start + r][s]}×{sub_weight_texts[sub_affix_json["type"]]}'
+                                     for s, sub_affix_json in enumerate(relic["sub_affix"])],
+                }
+                if name is not None:
+                    relic_result["name"] = name
+                relic_results.append(relic_result)
+            character_result[key] = relic_results
+        result.append(character_result)
+        start += len(relics)
+    return result
+
+
+def score_relics(chara_id, relics, standards=None):
+    # score_characters の1キャラ版 {weight key: [遺物ごとの結果]}
+    return score_characters([{"id": chara_id, "relics": relics}], standards)[0]
+
+
+def get_best_standard(chara_id, relics):
+    """Return (weight key, total relic score) of the standard that scores the relics highest."""
+    compiled = get_compiled_weights()
+    keys = get_standards(chara_id, compiled)
+    if not keys or not relics:
+        return None, 0
+    scores, _, _ = score_matrix(keys, relics, compiled)
+    # テンプレートと同じく遺物ごとに丸めてから合計する
+    totals = [sum(round(score * 100, 1) for score in row) for row in scores.tolist()]
+    best = max((n for n in range(len(keys)) if totals[n] == totals[n]), key=lambda n: totals[n], default=None)
+    if best is None:
+        return None, 0
+    return keys[best], totals[best]
+
+
+def check_scores(characters):
+    """Compare score_characters with get_relic_score; return the (index, key, relic) that differ."""
+    # utils は scoring より重いので、確認するときだけ読み込む
+    from generate.utils import get_relic_score
+    mismatches = []
+    for n, (character, result) in enumerate(zip(characters, score_characters(characters))):
+        for key, relic_results in result.items():
+            try:
+                expected = [get_relic_score(key, relic) for relic in character["relics"]]
+            except KeyError:
+                expected = None
+            if relic_results == expected:
+                continue
+            for r in range(len(character["relics"])):
+                if relic_results is None or expected is None or relic_results[r] != expected[r]:
+                    mismatches.append((n, key, r))
+    return mismatches
+
+
+if __name__ == "__main__":
+    # python -m generate.scoring profile.json (characters を持つ変換済みのプロフィール)
+    import main  # noqa: F401 (generate.utils は main から読み込まれる前提)
+    with open(sys.argv[1], encoding="utf-8") as f:
+        characters = json.load(f)["characters"]
+    mismatches = check_scores(characters)
+    print(f"{'mismatches':16} {len(mismatches):8d}")
+    for mismatch in mismatches[:10]:
+        print(mismatch)
+    from generate.utils import get_relic_score
+
+    # まとめて再計算する場合を想定して同じキャラを繰り返す
+    characters = characters * 100
+    start = time.perf_counter()
+    for character in characters:
+        for key in get_standards(character["id"]):
+            try:
+                [get_relic_score(key, relic) for relic in character["relics"]]
+            except KeyError:
+                pass
+    timings = {"get_relic_score": time.perf_counter() - start}
+    start = time.perf_counter()
+    score_characters(characters)
+    timings["score_characters"] = time.perf_counter() - start
+    for name, seconds in timings.items():
+        print(f"{name:16} {seconds * 1000:8.1f} ms")
+    sys.exit(1 if mismatches else 0)
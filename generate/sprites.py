@@ -0,0 +1,134 @@
+import hashlib
+import mmap
+import os
+import shutil
+import threading
+
+from PIL import Image
+
+from generate.data_version import generate_path
+
+# 空にするとディスクに保存しない
+SPRITE_CACHE_DIR = os.environ.get("SPRITE_CACHE_DIR", f"{generate_path}/sprites")
+
+
+def get_sprite_size(size, crop):
+    if crop is not None:
+        return crop[2] - crop[0], crop[3] - crop[1]
+    return size
+
+
+class SpriteStore:
+    """Resized/cropped images as raw RGBA files, one directory per template.
+
+    Files are named by the sha1 of the source image, so an upstream commit only replaces the
+    sprites of images whose content changed. They are memory-mapped and wrapped with
+    Image.frombuffer, so loading needs neither decoding nor resampling and the pages are shared
+    by every render process.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.write_errors = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def get_file_path(self, namespace, digest, size, crop):
+        # digest は元画像の sha1 (同じ内容の画像は同じファイルを使う)
+        width, height = get_sprite_size(size, crop)
+        name = hashlib.sha1(f"{size}|{crop}".encode("utf-8")).hexdigest()[:16]
+        return f"{self.path}/{namespace}/{digest}_{name}_{width}x{height}.rgba"
+
+    def load(self, namespace, digest, size, crop=None):
+        file_path = self.get_file_path(namespace, digest, size, crop)
+        width, height = get_sprite_size(size, crop)
+        try:
+            with open(file_path, "rb") as f:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        if len(buffer) != width * height * 4:
+            buffer.close()
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        # 読み取り専用のまま共有する (変更しないこと)
+        return Image.frombuffer("RGBA", (width, height), buffer, "raw", "RGBA", 0, 1)
+
+    def save(self, namespace, digest, size, crop, img):
+        file_path = self.get_file_path(namespace, digest, size, crop)
+        if img.mode != "RGBA" or img.size != get_sprite_size(size, crop):
+            return False
+        tmp_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                f.write(img.tobytes())
+            os.replace(tmp_path, file_path)
+        except OSError as e:
+            with self._lock:
+                self.write_errors += 1
+            print("sprite write failed")
+            print(e)
+            return False
+        with self._lock:
+            self.writes += 1
+        return True
+
+    def prune(self, keep, digests=None):
+        # 使わなくなったテンプレートのディレクトリと、digests に無い (内容が変わった) 画像のファイルを消す
+        if not self.enabled or not os.path.isdir(self.path):
+            return 0
+        removed = 0
+        for name in os.listdir(self.path):
+            if not os.path.isdir(f"{self.path}/{name}"):
+                continue
+            if name not in keep:
+                shutil.rmtree(f"{self.path}/{name}", ignore_errors=True)
+                removed += 1
+                continue
+            if digests is None:
+                continue
+            for entry in os.scandir(f"{self.path}/{name}"):
+                if entry.name.endswith(".rgba") and entry.name.split("_")[0] not in digests:
+                    try:
+                        os.remove(entry.path)
+                    except OSError:
+                        continue
+                    removed += 1
+        return removed
+
+    def stats(self):
+        files = 0
+        total_bytes = 0
+        namespaces = []
+        if self.enabled and os.path.isdir(self.path):
+            for name in sorted(os.listdir(self.path)):
+                namespaces.append(name)
+                for entry in os.scandir(f"{self.path}/{name}"):
+                    if entry.name.endswith(".rgba"):
+                        files += 1
+                        total_bytes += entry.stat().st_size
+        return {
+            "enabled": self.enabled,
+            "namespaces": namespaces,
+            "files": files,
+            "bytes": total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "writes": self.writes,
+            "write_errors": self.write_errors,
+        }
+
+
+sprite_store = SpriteStore(SPRITE_CACHE_DIR)
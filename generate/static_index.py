@@ -0,0 +1,130 @@
+import gzip
+import hashlib
+import json
+import os
+import re
+import threading
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from generate.data_version import data_version, res_path
+
+# /get_chara, /get_set_relic で返すファイル
+static_files = {
+    "characters": "characters.json",
+    "relic_sets": "relic_sets.json",
+}
+# index_min/{lang} のディレクトリ名 (パスに使うので形式を制限する)
+lang_pattern = re.compile(r"^[a-z]{2,4}$")
+
+
+class StaticPayload:
+    __slots__ = ("signature", "generation", "etag", "bodies")
+
+    def __init__(self, signature, generation, body):
+        self.signature = signature
+        self.generation = generation
+        self.etag = hashlib.sha256(body).hexdigest()
+        # Content-Encoding -> 送る内容
+        self.bodies = {"identity": body, "gzip": gzip.compress(body, 9, mtime=0)}
+        if brotli is not None:
+            self.bodies["br"] = brotli.compress(body, quality=11)
+
+
+def negotiate_encoding(accept_encoding, available):
+    """Pick the best of available ("br", "gzip", "identity") for an Accept-Encoding header."""
+    q_values = {}
+    for part in (accept_encoding or "").split(","):
+        params = part.strip().split(";")
+        coding = params[0].strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params[1:]:
+            name, _, value = param.strip().partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        q_values[coding] = q
+    # 受け付けられる圧縮があれば使う (q が同じなら br を優先)
+    best = None
+    for coding in ("br", "gzip"):
+        if coding not in available:
+            continue
+        q = q_values.get(coding, q_values.get("*", 0.0))
+        if q > 0 and (best is None or q > best[1]):
+            best = (coding, q)
+    return best[0] if best is not None else "identity"
+
+
+class StaticIndex:
+    """index_min JSON files serialized once per (lang, file) with precompressed variants.
+
+    Payloads are checked only when the index_min data version changes, and rebuilt only if
+    their own file changed (mtime/size), so requests neither parse JSON nor stat files.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.loads = 0
+        self._payloads = {}
+        self._lock = threading.Lock()
+
+    def get(self, lang, name):
+        if not lang_pattern.match(lang) or name not in static_files:
+            return None
+        key = (lang, name)
+        generation = data_version.get("res_index")
+        payload = self._payloads.get(key)
+        if payload is not None and payload.generation == generation:
+            self.hits += 1
+            return payload
+        path = f"{res_path}/index_min/{lang}/{static_files[name]}"
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if payload is not None and payload.signature == signature:
+            payload.generation = generation
+            self.hits += 1
+            return payload
+        with self._lock:
+            payload = self._payloads.get(key)
+            if payload is None or payload.signature != signature:
+                with open(path, encoding="utf-8") as f:
+                    contents = json.load(f)
+                # JSONResponse と同じ形式で送る
+                body = json.dumps(contents, ensure_ascii=False, allow_nan=False, indent=None,
+                                  separators=(",", ":")).encode("utf-8")
+                payload = StaticPayload(signature, generation, body)
+                self._payloads[key] = payload
+                self.loads += 1
+            return payload
+
+    def preload(self, langs=None):
+        index_min_path = f"{res_path}/index_min"
+        if langs is None:
+            langs = sorted(os.listdir(index_min_path)) if os.path.isdir(index_min_path) else []
+        for lang in langs:
+            for name in static_files:
+                self.get(lang, name)
+        return len(self._payloads)
+
+    def stats(self):
+        payloads = list(self._payloads.values())
+        return {
+            "payloads": len(payloads),
+            "bytes": sum(len(body) for payload in payloads for body in payload.bodies.values()),
+            "brotli": brotli is not None,
+            "hits": self.hits,
+            "loads": self.loads,
+        }
+
+
+static_index = StaticIndex()
@@ -1,12 +1,12 @@
 import math
 import os
 
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw
 
-from generate.utils import get_json_from_url, get_json_from_json, get_image_from_url, get_relic_score_text, \
+from generate.fonts import font_registry
+from generate.utils import get_json_from_url, get_json_from_json, get_resized_image, get_relic_score_text, \
     get_star_image_path_from_int, convert_old_roman_from_int, get_relic_score, get_file_path
 
-font_file_path = f"{get_file_path()}/assets/zh-cn.ttf"
 
 async def generate_panel(uid="805477392", chara_id=1, is_hideUID=False, calculating_standard="compatibility"):
     font_color = "#f0eaca"
@@ -24,35 +24,32 @@ async def generate_panel(uid="805477392", chara_id=1, is_hideUID=False, calculat
     )
     img = Image.alpha_composite(img, a)
     # img = img.rotate(90, expand=True)
-    small_font = ImageFont.truetype(font_file_path, 18)
-    skill_level_font = ImageFont.truetype(font_file_path, 25)
-    normal_font = ImageFont.truetype(font_file_path, 30)
-    title_font = ImageFont.truetype(font_file_path, 60)
-    retic_title_font = ImageFont.truetype(font_file_path, 25)
-    retic_main_affix_title_font = ImageFont.truetype(font_file_path, 27)
-    retic_main_affix_title_small_font = ImageFont.truetype(font_file_path, 25)
-    retic_formula_font = ImageFont.truetype(font_file_path, 18)
-    card_font = ImageFont.truetype(font_file_path, 36)
+    small_font = font_registry.get(18)
+    skill_level_font = font_registry.get(25)
+    normal_font = font_registry.get(30)
+    title_font = font_registry.get(60)
+    retic_title_font = font_registry.get(25)
+    retic_main_affix_title_font = font_registry.get(27)
+    retic_main_affix_title_small_font = font_registry.get(25)
+    retic_formula_font = font_registry.get(18)
+    card_font = font_registry.get(36)
 
     draw = ImageDraw.Draw(img)
 
     # キャライメージ
-    chara_img = Image.open(await get_image_from_url(
-        f"https://raw.githubusercontent.com/Mar-7th/StarRailRes/master/{helta_json['portrait']}")).resize(
-        (750, 750)).crop((150, 0, 550, 750))
+    chara_img = await get_resized_image(
+        f"https://raw.githubusercontent.com/Mar-7th/StarRailRes/master/{helta_json['portrait']}", (750, 750), (150, 0, 550, 750))
     img.paste(chara_img, (50, 50), chara_img)
     draw.rounded_rectangle((50, 50, 450, 800), radius=20, fill=None,
                            outline=font_color, width=2)
-    star_img = Image.open(await get_image_from_url(
-        f"https://raw.githubusercontent.com/Mar-7th/StarRailRes/master/{get_star_image_path_from_int(int(helta_json['rarity']))}")).resize(
-        (306, 72))
+    star_img = await get_resized_image(
+        f"https://raw.githubusercontent.com/Mar-7th/StarRailRes/master/{get_star_image_path_from_int(int(helta_json['rarity']))}", (306, 72))
     img.paste(star_img, (210, 50), star_img)
 
     # キャラステータス
     for index, i in enumerate(helta_json["attributes"]):
-        icon = Image.open(await get_image_from_url(
-            f"https://raw.githubusercontent.com/Mar-7th/StarRailRes/master/{i['icon']}")).resize(
-            (55, 55))
+        icon = await get_resized_image(
+            f"https://raw.githubusercontent.com/Mar-7th/StarRailRes/master/{i['icon']}", (55, 55))
         img.paste(icon, (500, 140 + index * 60), icon)
         draw.text((560, 150 + index * 60), f"{i['name']}", font_color, spacing=10, align='left', font=normal_font)
         '''draw.rounded_rectangle((490, 145 + index * 60, 1060, 155 + index * 60 + 36), radius=10, fill=None,
@@ -79,9 +76,8 @@ async def generate_panel(uid="805477392", chara_id=1, is_hideUID=False, calculat
     for index, i in enumerate(helta_json["properties"]):
         if i["field"] != "def" and i["field"] != "crit_rate" and i["field"] != "atk" and i["field"] != "hp" and i[
             "field"] != "crit_dmg" and i["field"] != "spd":
-            icon = Image.open(await get_image_from_url(
-                f"https://raw.githubusercontent.com/Mar-7th/StarRailRes/master/{i['icon']}")).resize(
-                (55, 55))
+            icon = await get_resized_image(
+                f"https://raw.githubusercontent.com/Mar-7th/StarRailRes/master/{i['icon']}", (55, 55))
             '''draw.rounded_rectangle((490, 505 + show_count * 60, 1060, 515 + show_count * 60 + 36), radius=10, fill=None,
                                    outline=font_color, width=2)'''
             img.paste(icon, (500, 500 + show_count * 60), icon)
@@ -93,16 +89,14 @@ async def generate_panel(uid="805477392", chara_id=1, is_hideUID=False, calculat
 
     # キャラタイトル
     draw.text((500, 50), helta_json['name'], "#f0eaca", spacing=10, align='left', font=title_font)
-    icon = Image.open(await get_image_from_url(
-        f"https://raw.githubusercontent.com/Mar-7th/StarRailRes/master/{helta_json['element']['icon']}")).resize(
-        (55, 55))
+    icon = await get_resized_image(
+        f"https://raw.githubusercontent.com/Mar-7th/StarRailRes/master/{helta_json['element']['icon']}", (55, 55))
     img.paste(icon, (500 + (len(helta_json['name'])) * 60, 70), icon)
     draw.text((500 + (len(helta_json['name'])) * 60 + 55, 90), f"Lv.{helta_json['level']}", font_color,
               font=normal_font)
     draw.line(((490, 135), (1060, 135)), fill=font_color, width=3)
-    path_icon = Image.open(await get_image_from_url(
-        f"https://raw.githubusercontent.com/Mar-7th/StarRailRes/master/{helta_json['path']['icon']}")).resize(
-        (50, 50))
+    path_icon = await get_resized_image(
+        f"https://raw.githubusercontent.com/Mar-7th/StarRailRes/master/{helta_json['path']['icon']}", (50, 50))
     img.paste(path_icon, (960, 80), path_icon)
     draw.text((1035, 105), f"{helta_json['promotion']}", font_color, font=normal_font, anchor="mm")
     draw.rounded_rectangle((1020, 82, 1050, 127), radius=2, fill=None,
@@ -110,13 +104,11 @@ async def generate_panel(uid="805477392", chara_id=1, is_hideUID=False, calculat
 
     # 遺物
     for index, i in enumerate(helta_json["relics"]):
-        icon = Image.open(await get_image_from_url(
-            f"https://raw.githubusercontent.com/Mar-7th/StarRailRes/master/{i['icon']}")).resize(
-            (100, 100))
-        star_img = Image.open(await get_image_from_url(
-            f"https://raw.githubusercontent.com/Mar-7th/StarRailRes/master/{get_star_image_path_from_int(i['rarity'])}")).resize(
-            (153, 36))
-        relic_score_json = await get_relic_score(helta_json["id"], i)
+        icon = await get_resized_image(
+            f"https://raw.githubusercontent.com/Mar-7th/StarRailRes/master/{i['icon']}", (100, 100))
+        star_img = await get_resized_image(
+            f"https://raw.githubusercontent.com/Mar-7th/StarRailRes/master/{get_star_image_path_from_int(i['rarity'])}", (153, 36))
+        relic_score_json = get_relic_score(helta_json["id"], i)
         relic_score = round(relic_score_json["score"] * 100, 1)
         if index < 3:
             '''draw.rounded_rectangle((1100, 50 + index * 330, 1490, 365 + index * 330), radius=10, fill=None,
@@ -181,12 +173,10 @@ async def generate_panel(uid="805477392", chara_id=1, is_hideUID=False, calculat
     if helta_json.get("light_cone"):
         '''draw.rounded_rectangle((50, 840, 1050, 1000), radius=10, fill=None,
                                outline=font_color, width=2)'''
-        card_img = Image.open(await get_image_from_url(
-            f"https://raw.githubusercontent.com/Mar-7th/StarRailRes/master/{helta_json['light_cone']['icon']}")).resize(
-            (160, 150))
-        card_star_img = Image.open(await get_image_from_url(
-            f"https://raw.githubusercontent.com/Mar-7th/StarRailRes/master/{get_star_image_path_from_int(int(helta_json['light_cone']['rarity']))}")).resize(
-            (214, 48))
+        card_img = await get_resized_image(
+            f"https://raw.githubusercontent.com/Mar-7th/StarRailRes/master/{helta_json['light_cone']['icon']}", (160, 150))
+        card_star_img = await get_resized_image(
+            f"https://raw.githubusercontent.com/Mar-7th/StarRailRes/master/{get_star_image_path_from_int(int(helta_json['light_cone']['rarity']))}", (214, 48))
         img.paste(card_img, (460, 840), card_img)
         draw.text((640, 870), f"{helta_json['light_cone']['name']}", font_color,
                   font=card_font)
@@ -225,9 +215,8 @@ async def generate_panel(uid="805477392", chara_id=1, is_hideUID=False, calculat
             if used_normal:
                 continue
             used_normal = True
-        skill_icon = Image.open(await get_image_from_url(
-            f"https://raw.githubusercontent.com/Mar-7th/StarRailRes/master/{i['icon']}")).resize(
-            (45, 45))
+        skill_icon = await get_resized_image(
+            f"https://raw.githubusercontent.com/Mar-7th/StarRailRes/master/{i['icon']}", (45, 45))
         img.paste(skill_icon, (70 + skill_index * 78, 722), skill_icon)
         draw.ellipse(((65 + skill_index * 78, 715), (120 + skill_index * 78, 770)), fill=None,
                      outline=font_color, width=3)
@@ -1,29 +1,358 @@
-import io
+import asyncio
+import hashlib
 import json
 import math
 import os
-import pathlib
 import textwrap
+from concurrent.futures import ThreadPoolExecutor
 
-import aiohttp
 import i18n
-from PIL import ImageDraw, Image, ImageFont
+from PIL import ImageDraw
+
+from generate import render, rolls
+from generate.asset_mirror import asset_mirror
+from generate.backgrounds import background_cache
+from generate.card_cache import card_cache, make_card_key
+from generate.data_version import data_version, generate_path, res_path
+from generate.encode import encode_image, media_types
+from generate.fonts import font_registry
+from generate.image_cache import decode_image
+from generate.sprites import sprite_store
+from generate.weights import weight_registry
+from generate.utils import get_json_from_url, get_json_from_json, load_asset_image, \
+    get_relic_score_text, get_star_image_path_from_int, convert_old_roman_from_int, get_relic_score, \
+    get_relic_full_score_text, get_relic_sets_score
+
+# テンプレートを変更したらディスク上の縮小済み画像を使わない
+with open(__file__, 'rb') as f:
+    template_digest = hashlib.sha1(f.read()).hexdigest()
+
+# カードの見た目に関わるコードと文言 (どれかを変更したらキャッシュ済みのカードを使わない)
+i18n_path = f"{os.path.dirname(generate_path)}/i18n"
+card_source_paths = [__file__] + [f"{generate_path}/{name}" for name in (
+    "utils.py", "rolls.py", "backgrounds.py", "fonts.py", "encode.py", "image_cache.py")] + \
+    [f"{i18n_path}/{name}" for name in sorted(os.listdir(i18n_path)) if name.endswith(".yml")]
+source_hash = hashlib.sha1()
+for source_path in card_source_paths:
+    with open(source_path, 'rb') as f:
+        source_hash.update(hashlib.sha1(f.read()).digest())
+card_source_digest = source_hash.hexdigest()
+
+# カードの見た目に関わるデータ (どれかの内容が変われば別のカードになる)
+# index_min はキャラの JSON と画像の sha1 として payload に入っているので含めない
+card_data_groups = ("weights", "rolls", "assets")
+
+base_property_fields = ("def", "crit_rate", "atk", "hp", "crit_dmg", "spd")
+
+# レイアウトは 1920x1080 基準で書いて、出力サイズに合わせて拡大縮小する
+base_width = 1920
+default_width = 1280
+min_width = 320
+max_width = 1920
+
+# draw_panel で使う 1920x1080 基準のフォントサイズ
+panel_font_sizes = (18, 25, 27, 30, 36, 60)
+
+# draw_panel で貼る画像の 1920x1080 基準のサイズ
+portrait_size = (750, 750)
+portrait_crop = (150, 0, 550, 750)
+chara_star_size = (306, 72)
+element_icon_size = (40, 40)
+property_icon_size = (55, 55)
+path_icon_size = (50, 50)
+relic_icon_size = (100, 100)
+relic_star_size = (153, 36)
+main_affix_icon_size = (42, 42)
+sub_affix_icon_size = (40, 40)
+light_cone_icon_size = (160, 150)
+light_cone_star_size = (214, 48)
+skill_icon_size = (45, 45)
+# キャライメージの上のスキル欄 (暗くする範囲)
+skill_strip = (50, 700, 450, 800)
+
+# 画像のデコード・リサイズを並行して行うスレッド数 (レンダープールのプロセスごと)
+ASSET_LOAD_WORKERS = int(os.environ.get("ASSET_LOAD_WORKERS", 4))
+asset_loader = None
+asset_loader_pid = None
+
+
+def get_panel_height(width):
+    return round(width * 9 / 16)
+
+
+def preload_fonts(width=default_width):
+    sc, _ = get_layout_scale(width)
+    return font_registry.preload([sc(size) for size in panel_font_sizes])
+
+
+def preload_render_worker(data_snapshot=None, width=default_width):
+    # レンダープールの各ワーカーで最初に1回だけ呼ばれる (親のデータの版を使い、ファイルは読み直さない)
+    if data_snapshot is not None:
+        data_version.adopt(data_snapshot)
+    background_cache.preload([(width, get_panel_height(width))])
+    preload_fonts(width)
 
-from generate.utils import get_json_from_url, get_json_from_json, get_image_from_url, get_relic_score_text, \
-    get_star_image_path_from_int, convert_old_roman_from_int, get_relic_score, get_file_path, get_relic_full_score_text, \
-    get_relic_sets_score
-
-font_file_path = f"{get_file_path()}/assets/zh-cn.ttf"
 
+async def generate_panel(uid="805477392", chara_id=1, is_hideUID=False, calculating_standard="compatibility",
+                         lang="jp", is_hide_roll=False, image_format="png", quality=None,
+                         width=default_width, not_modified=None):
+    json = await get_json_from_url(uid, lang)
+    if "detail" in json:
+        return json
+    return await generate_character_panel(json, chara_id, is_hideUID, calculating_standard, lang, is_hide_roll,
+                                          image_format, quality, width, not_modified)
 
 
-async def generate_panel(uid="805477392", chara_id=1, is_hideUID=False, calculating_standard="compatibility",
-                         lang="jp", is_hide_roll=False):
-    font_color = "#f0eaca"
-    touka_color = "#191919"
+async def generate_panels(uid="805477392", chara_ids=None, is_hideUID=False, calculating_standard="compatibility",
+                          lang="jp", is_hide_roll=False, image_format="png", quality=None,
+                          width=default_width):
+    # プロフィールを1回だけ取得して、指定したキャラ (無ければ全員) を並列に描画する
     json = await get_json_from_url(uid, lang)
     if "detail" in json:
         return json
+    if chara_ids is None:
+        chara_ids = range(len(json["characters"]))
+    chara_ids = [int(chara_id) for chara_id in chara_ids]
+    if not chara_ids or any(not 0 <= chara_id < len(json["characters"]) for chara_id in chara_ids):
+        return {"detail": 400}
+    panels = await asyncio.gather(*[
+        generate_character_panel(json, chara_id, is_hideUID, calculating_standard, lang, is_hide_roll,
+                                 image_format, quality, width)
+        for chara_id in chara_ids])
+    return {"chara_ids": chara_ids, "panels": panels}
+
+
+async def generate_character_panel(json, chara_id, is_hideUID, calculating_standard, lang, is_hide_roll,
+                                   image_format, quality, width, not_modified=None):
+    # not_modified(etag) が True ならカードを描かずに "not_modified" の結果を返す (If-None-Match 用)
+    helta_json = json["characters"][int(chara_id)]
+    payload = {
+        "character": helta_json,
+        "uid": json['player']['uid'],
+        "is_hideUID": is_hideUID,
+        "calculating_standard": calculating_standard,
+        "lang": lang,
+        "is_hide_roll": is_hide_roll,
+        "format": image_format,
+        "quality": quality,
+        "width": width,
+    }
+
+    # 手元に無い画像は描く前にまとめてダウンロードする (失敗・時間切れの分だけ透明で描く)
+    plan = plan_panel_assets(helta_json, width)
+    paths = list(dict.fromkeys(path for path, _, _ in plan))
+    missing_assets = await asset_mirror.resolve(paths)
+    # 使う画像の内容の sha1 (無い画像は None)。StarRailRes の他の画像が変わってもキーは変わらない
+    payload["assets"] = asset_mirror.get_digests(paths)
+
+    async def render_card():
+        return await render.submit(render_panel, payload, data_version.snapshot())
+
+    # キャラのデータと描画条件と画像が同じなら同じ画像になる (画像が揃ったら別のカードになる)
+    key = make_card_key(payload, card_source_digest, data_version.digest(*card_data_groups),
+                        os.path.basename(font_registry.get_font_path(lang)))
+    if not_modified is not None and not_modified(key):
+        # 順位のヘッダーに使うスコアだけ求める
+        return {"score": get_panel_score(helta_json, calculating_standard)["total_score"],
+                "chara_name": helta_json["name"], "avatar_id": helta_json["id"], "not_modified": True,
+                "etag": key, "cache": "NOT_MODIFIED", "missing_assets": len(missing_assets)}
+    result, cache_status = await card_cache.get_or_render(key, render_card)
+    return {**result, "etag": key, "cache": cache_status, "missing_assets": len(missing_assets)}
+
+
+def get_sprite_key(path, size, crop, sc):
+    return path, sc(*size), sc(*crop) if crop is not None else None
+
+
+def plan_panel_assets(helta_json, width=default_width):
+    """Every (path, size, crop) image that draw_panel pastes for this character and width."""
+    sc, _ = get_layout_scale(width)
+    sprites = [(helta_json['portrait'], portrait_size, portrait_crop),
+               (get_star_image_path_from_int(int(helta_json['rarity'])), chara_star_size, None),
+               (helta_json['element']['icon'], element_icon_size, None),
+               (helta_json['path']['icon'], path_icon_size, None)]
+    sprites += [(i['icon'], property_icon_size, None) for i in helta_json["attributes"]]
+    sprites += [(i['icon'], property_icon_size, None) for i in helta_json["properties"]
+                if i["field"] not in base_property_fields]
+    for i in helta_json["relics"]:
+        sprites += [(i['icon'], relic_icon_size, None),
+                    (get_star_image_path_from_int(i['rarity']), relic_star_size, None),
+                    (i['main_affix']['icon'], main_affix_icon_size, None)]
+        sprites += [(sub_i['icon'], sub_affix_icon_size, None) for sub_i in i["sub_affix"]]
+    if helta_json.get("light_cone"):
+        sprites += [(helta_json['light_cone']['icon'], light_cone_icon_size, None),
+                    (get_star_image_path_from_int(int(helta_json['light_cone']['rarity'])), light_cone_star_size,
+                     None)]
+    sprites += [(i['icon'], skill_icon_size, None) for i in select_skills(helta_json["skills"]) if i['icon'] is not None]
+    return list(dict.fromkeys(get_sprite_key(path, size, crop, sc) for path, size, crop in sprites))
+
+
+def get_sprite_namespace():
+    # テンプレートごとにディスク上の縮小済み画像を分ける (元画像の版はファイル名の sha1 で分かれる)
+    return f"two-{template_digest[:12]}"
+
+
+def build_sprites(width=default_width):
+    """Write the sprites every card needs regardless of the profile (portraits, rarity, element, path)."""
+    sc, _ = get_layout_scale(width)
+    if not sprite_store.enabled:
+        return 0
+    namespace = get_sprite_namespace()
+    index_json = {}
+    for name in ("characters", "elements", "paths"):
+        try:
+            with open(f"{res_path}/index_min/en/{name}.json", encoding="utf-8") as f:
+                index_json[name] = json.load(f)
+        except (OSError, ValueError):
+            index_json[name] = {}
+    sprites = [(v["portrait"], portrait_size, portrait_crop) for v in index_json["characters"].values()
+               if isinstance(v, dict) and v.get("portrait")]
+    sprites += [(v["icon"], element_icon_size, None) for v in index_json["elements"].values()
+                if isinstance(v, dict) and v.get("icon")]
+    sprites += [(v["icon"], path_icon_size, None) for v in index_json["paths"].values()
+                if isinstance(v, dict) and v.get("icon")]
+    for rarity in range(1, 6):
+        star_path = get_star_image_path_from_int(rarity)
+        sprites += [(star_path, chara_star_size, None), (star_path, relic_star_size, None),
+                    (star_path, light_cone_star_size, None)]
+    built = 0
+    for path, size, crop in dict.fromkeys(get_sprite_key(*sprite, sc) for sprite in sprites):
+        digest = asset_mirror.get_digest(path)
+        # まだダウンロードしていない画像と作成済みのものは飛ばす
+        if digest is None or os.path.exists(sprite_store.get_file_path(namespace, digest, size, crop)):
+            continue
+        try:
+            img = decode_image(f"{generate_path}/{path}", size, crop)
+        except OSError as e:
+            print(f"sprite {path} failed")
+            print(e)
+            continue
+        if sprite_store.save(namespace, digest, size, crop, img):
+            built += 1
+    sprite_store.prune({namespace}, asset_mirror.known_digests())
+    return built
+
+
+def get_asset_loader():
+    # プロセスごとに作る (fork したプロセスに親のスレッドは無い)
+    global asset_loader, asset_loader_pid
+    if asset_loader is None or asset_loader_pid != os.getpid():
+        asset_loader = ThreadPoolExecutor(max_workers=ASSET_LOAD_WORKERS, thread_name_prefix="asset")
+        asset_loader_pid = os.getpid()
+    return asset_loader
+
+
+def load_panel_assets(payload, plan):
+    """Load everything draw_panel needs: the planned images (in parallel), background and fonts."""
+    helta_json = payload["character"]
+    width = payload.get("width", default_width)
+    sc, _ = get_layout_scale(width)
+    # ディスクに置くのは build_sprites と同じ既定の幅だけ (幅は自由に指定できるので増え続けないように)
+    namespace = get_sprite_namespace() if width == default_width else None
+    digests = payload.get("assets", {})
+    images = dict(zip(plan, get_asset_loader().map(
+        lambda key: load_asset_image(*key, namespace, digests.get(key[0])), plan)))
+    strip = sc(*skill_strip)
+    return {
+        "images": images,
+        "background": background_cache.get(helta_json["element"]["color"], (width, get_panel_height(width))),
+        "fonts": {size: font_registry.get(sc(size), payload["lang"]) for size in panel_font_sizes},
+        "skill_strip": background_cache.get_tile((25, 25, 25, 128), (strip[2] - strip[0] + 1, strip[3] - strip[1] + 1)),
+    }
+
+
+def select_skills(skills):
+    selected = []
+    used_ultra = False
+    used_normal = False
+    for i in skills:
+        if len(selected) >= 5:
+            break
+        if i["max_level"] == 1 and i["type"] != "Maze":
+            continue
+        if i["type"] == "Ultra":
+            if used_ultra:
+                continue
+            used_ultra = True
+        elif i["type"] == "Normal":
+            if used_normal:
+                continue
+            used_normal = True
+        selected.append(i)
+    return selected
+
+
+def get_panel_score(helta_json, calculating_standard):
+    """Scores shown on the card of one character, without drawing anything."""
+    if calculating_standard != "compatibility" and calculating_standard != "no_score" and calculating_standard != "string":
+        weight_key = helta_json["id"] + "_" + calculating_standard
+    else:
+        weight_key = helta_json["id"]
+    relic_scores = []
+    relic_score_values = []
+    relic_full_score = 0
+    for i in helta_json["relics"]:
+        relic_score_json = get_relic_score(weight_key, i)
+        relic_score = round(relic_score_json["score"] * 100, 1)
+        relic_full_score += relic_score
+        relic_scores.append(relic_score_json)
+        relic_score_values.append(relic_score)
+    relic_sets_score = 0
+    total_score = 0
+    if calculating_standard != "no_score":
+        relic_sets_score = get_relic_sets_score(weight_key, helta_json["relic_sets"]).get("score", 0)
+        total_score = round(relic_full_score + relic_sets_score, 1)
+    return {
+        "weight_key": weight_key,
+        "relic_scores": relic_scores,
+        "relic_score_values": relic_score_values,
+        "relic_full_score": relic_full_score,
+        "relic_sets_score": relic_sets_score,
+        "total_score": total_score,
+    }
+
+
+def render_panel(payload, data_snapshot=None):
+    # レンダープール上で実行される (I/O はローカルの画像とフォントのみ)
+    if data_snapshot is not None:
+        data_version.adopt(data_snapshot)
+    weight_registry.refresh()
+    # 必要な画像を全部読み込んでから、I/O 無しで描く
+    plan = plan_panel_assets(payload["character"], payload.get("width", default_width))
+    result = draw_panel(payload, load_panel_assets(payload, plan))
+    image_format = payload.get("format", "png")
+    result['image'] = encode_image(result.pop('img'), image_format, payload.get("quality"))
+    result['media_type'] = media_types[image_format]
+    return result
+
+
+def get_layout_scale(width):
+    # 1920x1080 を基準にした座標・サイズを出力サイズに合わせる関数を返す
+    scale = width / base_width
+
+    def sc(*values):
+        if len(values) == 1:
+            return round(values[0] * scale)
+        return tuple(round(v * scale) for v in values)
+
+    def line_width(value):
+        return max(1, round(value * scale))
+
+    return sc, line_width
+
+
+def draw_panel(payload, assets):
+    """Draw one card from the profile payload and the images returned by load_panel_assets (no I/O)."""
+    helta_json = payload["character"]
+    is_hideUID = payload["is_hideUID"]
+    calculating_standard = payload["calculating_standard"]
+    lang = payload["lang"]
+    is_hide_roll = payload["is_hide_roll"]
+    width = payload.get("width", default_width)
+    height = get_panel_height(width)
+    sc, line_width = get_layout_scale(width)
+    font_color = "#f0eaca"
+    touka_color = "#191919"
     if lang == "jp" or lang == "cn" or lang == "cht":
         light_cone_name_limit = 9
         chara_name_limit = 7
@@ -32,126 +361,102 @@ async def generate_panel(uid="805477392", chara_id=1, is_hideUID=False, calculat
         light_cone_name_limit = 18
         chara_name_limit = 18
         relic_main_affix_name_limit = 10
-    helta_json = json["characters"][int(chara_id)]
-    img = Image.open(f"{get_file_path()}/assets/bkg.png").convert(
-        'RGBA')
-    color_code = helta_json["element"]["color"]
-    a = Image.new('RGBA', (1920, 1080))
-    draw_img = ImageDraw.Draw(a)
-    draw_img.rectangle(
-        ((0, 0), (1920, 1080)),
-        fill=(int(color_code[1:3], 16), int(color_code[3:5], 16), int(color_code[5:7], 16), 100)
-    )
-    img = Image.alpha_composite(img, a)
+    # 元素の色を重ねた背景 (描き込んでよいコピー)
+    img = assets["background"]
     # img = img.rotate(90, expand=True)
-    small_font = ImageFont.truetype(font_file_path, 18)
-    skill_level_font = ImageFont.truetype(font_file_path, 25)
-    normal_font = ImageFont.truetype(font_file_path, 30)
-    title_font = ImageFont.truetype(font_file_path, 60)
-    retic_title_font = ImageFont.truetype(font_file_path, 25)
-    retic_main_affix_title_font = ImageFont.truetype(font_file_path, 27)
-    retic_main_affix_title_small_font = ImageFont.truetype(font_file_path, 25)
-    retic_formula_font = ImageFont.truetype(font_file_path, 18)
-    card_font = ImageFont.truetype(font_file_path, 36)
+    fonts = assets["fonts"]
+    small_font = fonts[18]
+    skill_level_font = fonts[25]
+    normal_font = fonts[30]
+    title_font = fonts[60]
+    retic_title_font = fonts[25]
+    retic_main_affix_title_font = fonts[27]
+    retic_main_affix_title_small_font = fonts[25]
+    retic_formula_font = fonts[18]
+    card_font = fonts[36]
+
+    def sprite(path, size, crop=None):
+        return assets["images"][get_sprite_key(path, size, crop, sc)]
 
     draw = ImageDraw.Draw(img)
 
     # キャライメージ
-    chara_img = Image.open(await get_image_from_url(
-        f"https://raw.githubusercontent.com/Mar-7th/StarRailRes/master/{helta_json['portrait']}")).resize(
-        (750, 750)).crop((150, 0, 550, 750))
-    img.paste(chara_img, (50, 50), chara_img)
-    draw.rounded_rectangle((50, 50, 450, 800), radius=2, fill=None,
-                           outline=font_color, width=1)
-    star_img = Image.open(await get_image_from_url(
-        f"https://raw.githubusercontent.com/Mar-7th/StarRailRes/master/{get_star_image_path_from_int(int(helta_json['rarity']))}")).resize(
-        (306, 72))
-    img.paste(star_img, (210, 50), star_img)
-    draw.text((315, 105), f"Lv.{helta_json['level']}", font_color,
+    chara_img = sprite(helta_json['portrait'], portrait_size, portrait_crop)
+    img.paste(chara_img, sc(50, 50), chara_img)
+    draw.rounded_rectangle(sc(50, 50, 450, 800), radius=line_width(2), fill=None,
+                           outline=font_color, width=line_width(1))
+    star_img = sprite(get_star_image_path_from_int(int(helta_json['rarity'])), chara_star_size)
+    img.paste(star_img, sc(210, 50), star_img)
+    draw.text(sc(315, 105), f"Lv.{helta_json['level']}", font_color,
               font=normal_font)
-    icon = Image.open(await get_image_from_url(
-        f"https://raw.githubusercontent.com/Mar-7th/StarRailRes/master/{helta_json['element']['icon']}")).resize(
-        (40, 40))
-    img.paste(icon, (400, 100), icon)
+    icon = sprite(helta_json['element']['icon'], element_icon_size)
+    img.paste(icon, sc(400, 100), icon)
 
     # キャラステータス
     for index, i in enumerate(helta_json["attributes"]):
-        icon = Image.open(await get_image_from_url(
-            f"https://raw.githubusercontent.com/Mar-7th/StarRailRes/master/{i['icon']}")).resize(
-            (55, 55))
-        img.paste(icon, (500, 140 + index * 60), icon)
-        draw.text((560, 150 + index * 60), f"{i['name']}", font_color, spacing=10, align='left', font=normal_font)
-        draw.rounded_rectangle((490, 145 + index * 60, 1060, 155 + index * 60 + 36), radius=2, fill=None,
-                               outline=font_color, width=1)
+        icon = sprite(i['icon'], property_icon_size)
+        img.paste(icon, sc(500, 140 + index * 60), icon)
+        draw.text(sc(560, 150 + index * 60), f"{i['name']}", font_color, spacing=sc(10), align='left', font=normal_font)
+        draw.rounded_rectangle(sc(490, 145 + index * 60, 1060, 155 + index * 60 + 36), radius=line_width(2), fill=None,
+                               outline=font_color, width=line_width(1))
         if i["field"] != "crit_rate" and i["field"] != "crit_dmg":
-            draw.text((1050, 150 + index * 60), f"{i['display']}", font_color, spacing=10, align='right',
+            draw.text(sc(1050, 150 + index * 60), f"{i['display']}", font_color, spacing=sc(10), align='right',
                       font=small_font, anchor='ra')
             addition = get_json_from_json(helta_json["additions"], "field", i["field"])
-            draw.text((1050, 150 + index * 60 + 18), f"+{addition.get('display', '0')}", "#9be802", spacing=10,
+            draw.text(sc(1050, 150 + index * 60 + 18), f"+{addition.get('display', '0')}", "#9be802", spacing=sc(10),
                       align='right',
                       font=small_font, anchor='ra')
-            draw.text((980, 150 + index * 60), f"{int(i['display']) + int(addition.get('display', '0'))}", font_color,
+            draw.text(sc(980, 150 + index * 60), f"{int(i['display']) + int(addition.get('display', '0'))}", font_color,
                       font=normal_font, anchor='ra')
         else:
-            draw.text((1050, 150 + index * 60), f"{i['display']}", font_color, spacing=10, align='right',
+            draw.text(sc(1050, 150 + index * 60), f"{i['display']}", font_color, spacing=sc(10), align='right',
                       font=small_font, anchor='ra')
             addition = get_json_from_json(helta_json["additions"], "field", i["field"])
-            draw.text((1050, 150 + index * 60 + 18), f"+{addition.get('display', '0')}", "#9be802", spacing=10,
+            draw.text(sc(1050, 150 + index * 60 + 18), f"+{addition.get('display', '0')}", "#9be802", spacing=sc(10),
                       align='right',
                       font=small_font, anchor='ra')
-            draw.text((980, 150 + index * 60),
+            draw.text(sc(980, 150 + index * 60),
                       f"{math.floor((float(i['value']) + float(addition.get('value', '0'))) * 1000) / 10}%", font_color,
                       font=normal_font, anchor='ra')
     show_count = 0
     for index, i in enumerate(helta_json["properties"]):
+        # キャッシュ済みのプロフィールを書き換えないようにコピーした値で表示する
+        property_display = i["display"]
         if i["field"] == "sp_rate":
-            i["display"] = str(round((i["value"] + 1) * 100, 1)) + "%"
-        if i["field"] != "def" and i["field"] != "crit_rate" and i["field"] != "atk" and i["field"] != "hp" and i[
-            "field"] != "crit_dmg" and i["field"] != "spd":
-            icon = Image.open(await get_image_from_url(
-                f"https://raw.githubusercontent.com/Mar-7th/StarRailRes/master/{i['icon']}")).resize(
-                (55, 55))
-            draw.rounded_rectangle((490, 505 + show_count * 60, 1060, 515 + show_count * 60 + 36), radius=2, fill=None,
-                                   outline=font_color, width=1)
-            img.paste(icon, (500, 500 + show_count * 60), icon)
-            draw.text((560, 510 + show_count * 60), f"{i['name']}", font_color, spacing=10, align='left',
+            property_display = str(round((i["value"] + 1) * 100, 1)) + "%"
+        if i["field"] not in base_property_fields:
+            icon = sprite(i['icon'], property_icon_size)
+            draw.rounded_rectangle(sc(490, 505 + show_count * 60, 1060, 515 + show_count * 60 + 36), radius=line_width(2),
+                                   fill=None, outline=font_color, width=line_width(1))
+            img.paste(icon, sc(500, 500 + show_count * 60), icon)
+            draw.text(sc(560, 510 + show_count * 60), f"{i['name']}", font_color, spacing=sc(10), align='left',
                       font=normal_font)
-            draw.text((1050, 510 + show_count * 60), f"{i['display']}", font_color, spacing=10, align='right',
+            draw.text(sc(1050, 510 + show_count * 60), f"{property_display}", font_color, spacing=sc(10), align='right',
                       font=normal_font, anchor='ra')
             show_count += 1
 
     # キャラタイトル
-    draw.multiline_text((500, 140), '\n'.join(textwrap.wrap(helta_json['name'], chara_name_limit)), "#f0eaca",
+    draw.multiline_text(sc(500, 140), '\n'.join(textwrap.wrap(helta_json['name'], chara_name_limit)), "#f0eaca",
                         anchor="ld", font=title_font)
 
-    draw.line(((490, 135), (1060, 135)), fill=font_color, width=3)
-    path_icon = Image.open(await get_image_from_url(
-        f"https://raw.githubusercontent.com/Mar-7th/StarRailRes/master/{helta_json['path']['icon']}")).resize(
-        (50, 50))
-    img.paste(path_icon, (960, 80), path_icon)
-    draw.text((1035, 105), f"{helta_json['rank']}", font_color, font=normal_font, anchor="mm")
-    draw.rounded_rectangle((1020, 82, 1050, 127), radius=2, fill=None,
-                           outline=font_color, width=2)
-    relic_full_score = 0
+    draw.line((sc(490, 135), sc(1060, 135)), fill=font_color, width=line_width(3))
+    path_icon = sprite(helta_json['path']['icon'], path_icon_size)
+    img.paste(path_icon, sc(960, 80), path_icon)
+    draw.text(sc(1035, 105), f"{helta_json['rank']}", font_color, font=normal_font, anchor="mm")
+    draw.rounded_rectangle(sc(1020, 82, 1050, 127), radius=line_width(2), fill=None,
+                           outline=font_color, width=line_width(2))
+    panel_score = get_panel_score(helta_json, calculating_standard)
+    relic_full_score = panel_score["relic_full_score"]
+    if is_hide_roll is False:
+        character_rolls = rolls.get_character_rolls(helta_json)
     # 遺物
     for index, i in enumerate(helta_json["relics"]):
-        icon = Image.open(await get_image_from_url(
-            f"https://raw.githubusercontent.com/Mar-7th/StarRailRes/master/{i['icon']}")).resize(
-            (100, 100))
-        star_img = Image.open(await get_image_from_url(
-            f"https://raw.githubusercontent.com/Mar-7th/StarRailRes/master/{get_star_image_path_from_int(i['rarity'])}")).resize(
-            (153, 36))
-        main_attribute_icon = Image.open(await get_image_from_url(
-            f"https://raw.githubusercontent.com/Mar-7th/StarRailRes/master/{i['main_affix']['icon']}")).resize(
-            (42, 42))
-
-        relic_score_json = {}
-        if calculating_standard != "compatibility" and calculating_standard != "no_score" and calculating_standard != "string":
-            relic_score_json = await get_relic_score(helta_json["id"]+"_"+calculating_standard, i)
-        else:
-            relic_score_json = await get_relic_score(helta_json["id"], i)
-        relic_score = round(relic_score_json["score"] * 100, 1)
-        relic_full_score += relic_score
+        icon = sprite(i['icon'], relic_icon_size)
+        star_img = sprite(get_star_image_path_from_int(i['rarity']), relic_star_size)
+        main_attribute_icon = sprite(i['main_affix']['icon'], main_affix_icon_size)
+
+        relic_score_json = panel_score["relic_scores"][index]
+        relic_score = panel_score["relic_score_values"][index]
         relic_main_affix_name = '\n'.join(textwrap.wrap(i['main_affix']['name'], relic_main_affix_name_limit))
 
         if index >= 3:
@@ -160,42 +465,40 @@ async def generate_panel(uid="805477392", chara_id=1, is_hideUID=False, calculat
         else:
             relic_index = index
             yoko_zure = 0
-        draw.rounded_rectangle((1100 + yoko_zure, 50 + relic_index * 330, 1490 + yoko_zure, 365 + relic_index * 330),
-                               radius=2, fill=None,
-                               outline=font_color, width=1)
-        img.paste(icon, (1110 + yoko_zure, 60 + relic_index * 330), icon)
+        draw.rounded_rectangle(sc(1100 + yoko_zure, 50 + relic_index * 330, 1490 + yoko_zure, 365 + relic_index * 330),
+                               radius=line_width(2), fill=None,
+                               outline=font_color, width=line_width(1))
+        img.paste(icon, sc(1110 + yoko_zure, 60 + relic_index * 330), icon)
 
-        img.paste(main_attribute_icon, (1200 + yoko_zure, 62 + relic_index * 330), main_attribute_icon)
+        img.paste(main_attribute_icon, sc(1200 + yoko_zure, 62 + relic_index * 330), main_attribute_icon)
         relice_effect_value = i['main_affix']['display']
 
         # 速度小数点表示
         if i['main_affix']['type'] == "SpeedDelta":
             relice_effect_value = round(i['main_affix']['value'], 1)
 
-        draw.text((1240 + yoko_zure, 100 + relic_index * 330), f"{relic_main_affix_name}\n{relice_effect_value}",
+        draw.text(sc(1240 + yoko_zure, 100 + relic_index * 330), f"{relic_main_affix_name}\n{relice_effect_value}",
                   font_color,
                   font=retic_main_affix_title_font, anchor="lm")
 
-        draw.rounded_rectangle((1195 + yoko_zure, 145 + relic_index * 330, 1245 + yoko_zure, 173 + relic_index * 330),
-                               radius=2, fill=None,
-                               outline=font_color, width=2)
-        draw.text((1220 + yoko_zure, 160 + relic_index * 330), f"+{i['level']}", font_color,
+        draw.rounded_rectangle(sc(1195 + yoko_zure, 145 + relic_index * 330, 1245 + yoko_zure, 173 + relic_index * 330),
+                               radius=line_width(2), fill=None,
+                               outline=font_color, width=line_width(2))
+        draw.text(sc(1220 + yoko_zure, 160 + relic_index * 330), f"+{i['level']}", font_color,
                   font=retic_title_font, anchor="mm")
 
         # スコア
         if calculating_standard != "no_score":
-            draw.text((1440 + yoko_zure, 135 + relic_index * 330), f"{relic_score}", font_color,
+            draw.text(sc(1440 + yoko_zure, 135 + relic_index * 330), f"{relic_score}", font_color,
                       font=retic_title_font, anchor="mm")
-            draw.text((1440 + yoko_zure, 95 + relic_index * 330), f"{get_relic_score_text(relic_score)}", font_color,
+            draw.text(sc(1440 + yoko_zure, 95 + relic_index * 330), f"{get_relic_score_text(relic_score)}", font_color,
                       font=title_font, anchor="mm")
 
-        img.paste(star_img, (1075 + yoko_zure, 140 + relic_index * 330), star_img)
+        img.paste(star_img, sc(1075 + yoko_zure, 140 + relic_index * 330), star_img)
         for sub_index, sub_i in enumerate(i["sub_affix"]):
-            sub_affix_icon = Image.open(await get_image_from_url(
-                f"https://raw.githubusercontent.com/Mar-7th/StarRailRes/master/{sub_i['icon']}")).resize(
-                (40, 40))
-            img.paste(sub_affix_icon, (1100 + yoko_zure, 175 + relic_index * 330 + sub_index * 50), sub_affix_icon)
-            draw.text((1140 + yoko_zure, 180 + relic_index * 330 + sub_index * 50), f"{sub_i['name']}", font_color,
+            sub_affix_icon = sprite(sub_i['icon'], sub_affix_icon_size)
+            img.paste(sub_affix_icon, sc(1100 + yoko_zure, 175 + relic_index * 330 + sub_index * 50), sub_affix_icon)
+            draw.text(sc(1140 + yoko_zure, 180 + relic_index * 330 + sub_index * 50), f"{sub_i['name']}", font_color,
                       font=retic_title_font)
 
             relice_subeffect_value = sub_i['display']
@@ -204,130 +507,92 @@ async def generate_panel(uid="805477392", chara_id=1, is_hideUID=False, calculat
             if sub_i['type'] == "SpeedDelta":
                 relice_subeffect_value = round(sub_i['value'], 1)
 
-            draw.text((1480 + yoko_zure, 180 + relic_index * 330 + sub_index * 50), f"{relice_subeffect_value}", font_color,
-                      font=retic_title_font, anchor='ra')
+            draw.text(sc(1480 + yoko_zure, 180 + relic_index * 330 + sub_index * 50), f"{relice_subeffect_value}",
+                      font_color, font=retic_title_font, anchor='ra')
 
             if is_hide_roll is False:
-                rolls = get_rolls(i['rarity'], sub_i)
+                sub_rolls = character_rolls[index][sub_index]
                 drew_rolls = [0, 0, 0]
-                for roll_high in range(rolls[0] + rolls[1] + rolls[2]):
-                    if drew_rolls[2] < rolls[2]:
+                for roll_high in range(sub_rolls[0] + sub_rolls[1] + sub_rolls[2]):
+                    if drew_rolls[2] < sub_rolls[2]:
                         roll_len = 40
                         roll = 2
-                    elif drew_rolls[1] < rolls[1]:
+                    elif drew_rolls[1] < sub_rolls[1]:
                         roll_len = 25
                         roll = 1
                     else:
                         roll_len = 10
                         roll = 0
                     before_rolls_len = get_roll_line_margin(drew_rolls)
-                    draw.line([(1140 + yoko_zure + before_rolls_len, 177 + relic_index * 330 + sub_index * 50),
-                               (1140 + roll_len + yoko_zure + before_rolls_len,
-                                177 + relic_index * 330 + sub_index * 50)],
-                              fill=font_color, width=2)
+                    draw.line([sc(1140 + yoko_zure + before_rolls_len, 177 + relic_index * 330 + sub_index * 50),
+                               sc(1140 + roll_len + yoko_zure + before_rolls_len,
+                                  177 + relic_index * 330 + sub_index * 50)],
+                              fill=font_color, width=line_width(2))
                     drew_rolls[roll] += 1
 
             if calculating_standard != "no_score":
-                draw.text((1480 + yoko_zure, 165 + relic_index * 330 + sub_index * 50),
+                draw.text(sc(1480 + yoko_zure, 165 + relic_index * 330 + sub_index * 50),
                           f"{relic_score_json['sub_formulas'][sub_index]}",
                           "#808080", font=retic_formula_font, anchor='ra')
 
     # relic合計スコアor遺物組み合わせ
-    draw.rounded_rectangle((50, 840, 450, 1000), radius=2, fill=None,
-                           outline=font_color, width=1)
-    total_score = 0
+    draw.rounded_rectangle(sc(50, 840, 450, 1000), radius=line_width(2), fill=None,
+                           outline=font_color, width=line_width(1))
+    total_score = panel_score["total_score"]
     if calculating_standard != "no_score":
-        # Calculate relic sets score
-        relic_sets_score_json = {}
-        if calculating_standard != "compatibility" and calculating_standard != "no_score" and calculating_standard != "string":
-            relic_sets_score_json = await get_relic_sets_score(helta_json["id"]+"_"+calculating_standard, helta_json["relic_sets"])
-        else:
-            relic_sets_score_json = await get_relic_sets_score(helta_json["id"], helta_json["relic_sets"])
-
-        relic_sets_score = relic_sets_score_json.get("score", 0)
-        total_score = round(relic_full_score + relic_sets_score, 1)
-
-        draw.text((80, 870), f"{i18n.t('message.score', locale=lang)}{round(total_score, 1)}", font_color,
+        draw.text(sc(80, 870), f"{i18n.t('message.score', locale=lang)}{round(total_score, 1)}", font_color,
                   font=card_font)
-        draw.text((380, 920), f"{get_relic_full_score_text(relic_full_score)}", font_color,
+        draw.text(sc(380, 920), f"{get_relic_full_score_text(relic_full_score)}", font_color,
                   font=title_font, anchor="mm")
         if calculating_standard != "compatibility":
-            draw.text((80, 930), relic_score_json.get("name", i18n.t('message.compatibility_criteria', locale=lang)), font_color,
+            draw.text(sc(80, 930), relic_score_json.get("name", i18n.t('message.compatibility_criteria', locale=lang)), font_color,
                       font=card_font)
         else:
-            draw.text((80, 930), i18n.t('message.compatibility_criteria', locale=lang), font_color,
+            draw.text(sc(80, 930), i18n.t('message.compatibility_criteria', locale=lang), font_color,
                       font=card_font)
     else:
         for sets_index, sets in enumerate(helta_json["relic_sets"]):
-            draw.text((80, 865 + sets_index * 40), f"{sets['num']} - {sets['name']}", font_color,
+            draw.text(sc(80, 865 + sets_index * 40), f"{sets['num']} - {sets['name']}", font_color,
                       font=retic_main_affix_title_font)
 
     # カード
     if helta_json.get("light_cone"):
-        draw.rounded_rectangle((490, 840, 1060, 1000), radius=2, fill=None,
-                               outline=font_color, width=1)
-        card_img = Image.open(await get_image_from_url(
-            f"https://raw.githubusercontent.com/Mar-7th/StarRailRes/master/{helta_json['light_cone']['icon']}")).resize(
-            (160, 150))
-        card_star_img = Image.open(await get_image_from_url(
-            f"https://raw.githubusercontent.com/Mar-7th/StarRailRes/master/{get_star_image_path_from_int(int(helta_json['light_cone']['rarity']))}")).resize(
-            (214, 48))
-        img.paste(card_img, (500, 840), card_img)
-        draw.multiline_text((700, 890),
+        draw.rounded_rectangle(sc(490, 840, 1060, 1000), radius=line_width(2), fill=None,
+                               outline=font_color, width=line_width(1))
+        card_img = sprite(helta_json['light_cone']['icon'], light_cone_icon_size)
+        card_star_img = sprite(get_star_image_path_from_int(int(helta_json['light_cone']['rarity'])),
+                               light_cone_star_size)
+        img.paste(card_img, sc(500, 840), card_img)
+        draw.multiline_text(sc(700, 890),
                             '\n'.join(textwrap.wrap(helta_json['light_cone']['name'], light_cone_name_limit)),
                             font_color,
                             font=card_font, anchor="lm")
-        draw.line(((680, 860), (680, 980)), fill=font_color, width=1)
-        img.paste(card_star_img, (460, 950), card_star_img)
-        draw.text((705, 930), f"Lv.{helta_json['light_cone']['level']}", font_color,
+        draw.line((sc(680, 860), sc(680, 980)), fill=font_color, width=line_width(1))
+        img.paste(card_star_img, sc(460, 950), card_star_img)
+        draw.text(sc(705, 930), f"Lv.{helta_json['light_cone']['level']}", font_color,
                   font=card_font)
-        draw.text((830, 930), f"{convert_old_roman_from_int(int(helta_json['light_cone']['rank']))}", font_color,
+        draw.text(sc(830, 930), f"{convert_old_roman_from_int(int(helta_json['light_cone']['rank']))}", font_color,
                   font=card_font)
 
     # UID
     if is_hideUID is not True:
-        draw.text((50, 1010), f"UID: {json['player']['uid']}", font_color,
+        draw.text(sc(50, 1010), f"UID: {payload['uid']}", font_color,
                   font=normal_font)
 
-    # スキルレベル
-    a = Image.new('RGBA', (1920, 1080))
-    draw_img = ImageDraw.Draw(a)
-    draw_img.rectangle(
-        ((50, 700), (450, 800)),
-        fill=(25, 25, 25, 128)
-    )
-    img = Image.alpha_composite(img, a)
-    draw = ImageDraw.Draw(img)
-    skill_index = 0
-    used_ultra = False
-    used_normal = False
-    for index, i in enumerate(helta_json["skills"]):
-        if skill_index >= 5:
-            break
-        if i["max_level"] == 1 and i["type"] != "Maze":
-            continue
-        if i["type"] == "Ultra":
-            if used_ultra:
-                continue
-            used_ultra = True
-        elif i["type"] == "Normal":
-            if used_normal:
-                continue
-            used_normal = True
+    # スキルレベル (キャライメージの上を暗くする)
+    img.alpha_composite(assets["skill_strip"], sc(*skill_strip[:2]))
+    for skill_index, i in enumerate(select_skills(helta_json["skills"])):
         if i['icon'] is not None:
-            skill_icon = Image.open(await get_image_from_url(
-            f"https://raw.githubusercontent.com/Mar-7th/StarRailRes/master/{i['icon']}")).resize(
-            (45, 45))
-            img.paste(skill_icon, (70 + skill_index * 78, 722), skill_icon)
-        draw.ellipse(((65 + skill_index * 78, 715), (120 + skill_index * 78, 770)), fill=None,
-                     outline=font_color, width=3)
-        draw.rounded_rectangle((73 + skill_index * 78, 762, 112 + skill_index * 78, 788), radius=4, fill="#ffffff")
-        draw.text((93 + skill_index * 78, 775), f"{i['level']}", "#000000",
+            skill_icon = sprite(i['icon'], skill_icon_size)
+            img.paste(skill_icon, sc(70 + skill_index * 78, 722), skill_icon)
+        draw.ellipse((sc(65 + skill_index * 78, 715), sc(120 + skill_index * 78, 770)), fill=None,
+                     outline=font_color, width=line_width(3))
+        draw.rounded_rectangle(sc(73 + skill_index * 78, 762, 112 + skill_index * 78, 788), radius=line_width(4),
+                               fill="#ffffff")
+        draw.text(sc(93 + skill_index * 78, 775), f"{i['level']}", "#000000",
                   font=skill_level_font, align="center", anchor="mm")
-        skill_index += 1
 
     result = {}
-    img = img.resize((1280, 720), Image.LANCZOS)
     result['img'] = img
     result['score'] = total_score
     result['chara_name'] = helta_json['name']
@@ -337,24 +602,7 @@ async def generate_panel(uid="805477392", chara_id=1, is_hideUID=False, calculat
 
 
 def get_rolls(rarity, stats):
-    with open(f"{get_file_path()}/rolls.json") as f:
-        rolls_json = json.load(f)
-    low = rolls_json[stats["type"]][str(rarity)][0]
-    mid = rolls_json[stats["type"]][str(rarity)][1]
-    high = rolls_json[stats["type"]][str(rarity)][2]
-    value = stats["value"]
-    result = None
-    max_margin = 100
-    for i in range(rarity + 1):
-        for j in range(rarity + 1):
-            for k in range(rarity + 1):
-                if i + j + k > rarity + 1:
-                    break
-                value_sum = i * low + j * mid + k * high
-                if abs(value_sum - value) < max_margin:
-                    max_margin = abs(value_sum - value)
-                    result = [i, j, k]
-    return result
+    return rolls.get_rolls(rarity, stats)
 
 
 def get_roll_line_margin(before_line):
@@ -0,0 +1,195 @@
+import asyncio
+import os
+import time
+from collections import deque
+
+import aiohttp
+
+# mihomo の応答がこの遅延 (最近の p95 から決める) より遅ければ enka にも並行して問い合わせる
+UPSTREAM_HEDGE_MIN_DELAY = float(os.environ.get("UPSTREAM_HEDGE_MIN_DELAY", 0.2))
+UPSTREAM_HEDGE_MAX_DELAY = float(os.environ.get("UPSTREAM_HEDGE_MAX_DELAY", 3))
+# 計測が少ないうちに使う遅延
+UPSTREAM_HEDGE_DEFAULT_DELAY = float(os.environ.get("UPSTREAM_HEDGE_DEFAULT_DELAY", 1))
+UPSTREAM_LATENCY_SAMPLES = int(os.environ.get("UPSTREAM_LATENCY_SAMPLES", 200))
+UPSTREAM_MIN_SAMPLES = int(os.environ.get("UPSTREAM_MIN_SAMPLES", 20))
+# 連続でこの回数失敗したらしばらくそのプロバイダを使わない
+UPSTREAM_CIRCUIT_FAILURES = int(os.environ.get("UPSTREAM_CIRCUIT_FAILURES", 5))
+UPSTREAM_CIRCUIT_OPEN_SECONDS = float(os.environ.get("UPSTREAM_CIRCUIT_OPEN_SECONDS", 30))
+
+
+class UpstreamError(Exception):
+    """Provider is unhealthy (timeout, connection error, 5xx or 429), as opposed to a valid error answer."""
+
+
+# プロバイダの不調として数える例外 (それ以外は応答の変換などこちら側の失敗)
+provider_errors = (UpstreamError, aiohttp.ClientError, asyncio.TimeoutError)
+
+
+def is_valid_result(result):
+    return bool(result) and "detail" not in result
+
+
+class Provider:
+    def __init__(self, name):
+        self.name = name
+        self.latencies = deque(maxlen=UPSTREAM_LATENCY_SAMPLES)
+        self.requests = 0
+        self.successes = 0
+        self.failures = 0
+        self.cancelled = 0
+        self.errors = 0
+        self.consecutive_failures = 0
+        self.opened_until = 0.0
+        self.circuit_opens = 0
+
+    def p95(self):
+        if len(self.latencies) < UPSTREAM_MIN_SAMPLES:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+
+    def is_open(self, now=None):
+        # 開いている間は使わない。時間が過ぎたら次のリクエストで試す (失敗したらまた開く)
+        return (now or time.time()) < self.opened_until
+
+    def record_success(self, latency):
+        self.successes += 1
+        self.consecutive_failures = 0
+        self.opened_until = 0.0
+        self.latencies.append(latency)
+
+    def record_failure(self):
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= UPSTREAM_CIRCUIT_FAILURES:
+            if not self.is_open():
+                self.circuit_opens += 1
+            self.opened_until = time.time() + UPSTREAM_CIRCUIT_OPEN_SECONDS
+
+    def stats(self):
+        p95 = self.p95()
+        return {
+            "requests": self.requests,
+            "successes": self.successes,
+            "failures": self.failures,
+            "cancelled": self.cancelled,
+            "errors": self.errors,
+            "error_rate": round(self.failures / self.requests, 3) if self.requests else 0.0,
+            "p95_ms": round(p95 * 1000, 1) if p95 is not None else None,
+            "circuit": "open" if self.is_open() else "closed",
+            "consecutive_failures": self.consecutive_failures,
+            "circuit_opens": self.circuit_opens,
+        }
+
+
+class UpstreamRouter:
+    """Fetch a profile from a primary provider, hedging to a secondary one when it is slow or failing.
+
+    Provider functions are coroutine functions returning a result dict; a dict with "detail" is a
+    valid answer from a healthy provider (e.g. unknown uid). Transport failures (provider_errors)
+    count towards opening that provider's circuit; any other exception, such as a failed
+    conversion, becomes a {"detail": 500} answer.
+    """
+
+    def __init__(self, primary, secondary):
+        self.primary = Provider(primary)
+        self.secondary = Provider(secondary)
+        self.decisions = {
+            "primary": 0,
+            "fallback": 0,
+            "hedged": 0,
+            "hedge_won": 0,
+            "circuit_skip": 0,
+            "secondary_only": 0,
+            "failed": 0,
+        }
+
+    def get_hedge_delay(self):
+        p95 = self.primary.p95()
+        if p95 is None:
+            return UPSTREAM_HEDGE_DEFAULT_DELAY
+        return min(UPSTREAM_HEDGE_MAX_DELAY, max(UPSTREAM_HEDGE_MIN_DELAY, p95))
+
+    async def _call(self, provider, func):
+        provider.requests += 1
+        start = time.perf_counter()
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            provider.cancelled += 1
+            raise
+        except provider_errors as e:
+            print(f"upstream {provider.name} failed")
+            print(repr(e))
+            provider.record_failure()
+            raise
+        except Exception as e:
+            # プロバイダは応答しているので回路は開かない
+            print(f"upstream {provider.name} result failed")
+            print(repr(e))
+            provider.errors += 1
+            result = {"detail": 500}
+        provider.record_success(time.perf_counter() - start)
+        return result
+
+    async def fetch(self, primary_func, secondary_func):
+        # primary_func が None なら secondary だけに問い合わせる
+        primary, secondary = self.primary, self.secondary
+        if primary_func is None or (primary.is_open() and not secondary.is_open()):
+            self.decisions["secondary_only" if primary_func is None else "circuit_skip"] += 1
+            return await self._finish([asyncio.ensure_future(self._call(secondary, secondary_func))])
+
+        primary_task = asyncio.ensure_future(self._call(primary, primary_func))
+        hedge_delay = self.get_hedge_delay() if not secondary.is_open() else None
+        done, _ = await asyncio.wait([primary_task], timeout=hedge_delay)
+        if done:
+            result = self._get_result(primary_task)
+            if is_valid_result(result):
+                self.decisions["primary"] += 1
+                return result
+            # mihomo が失敗したか見つからなかった
+            self.decisions["fallback"] += 1
+            fallback = await self._finish([asyncio.ensure_future(self._call(secondary, secondary_func))])
+            return fallback if fallback is not None or result is None else result
+
+        self.decisions["hedged"] += 1
+        secondary_task = asyncio.ensure_future(self._call(secondary, secondary_func))
+        result = await self._finish([primary_task, secondary_task])
+        if is_valid_result(result) and secondary_task.done() and result is self._get_result(secondary_task):
+            self.decisions["hedge_won"] += 1
+        return result
+
+    def _get_result(self, task):
+        if task.cancelled() or task.exception() is not None:
+            return None
+        return task.result()
+
+    async def _finish(self, tasks):
+        # 最初に届いた有効な結果を使い、残りは取り消す。全部だめなら最後の結果 (無ければ None)
+        pending = set(tasks)
+        last = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    result = self._get_result(task)
+                    if is_valid_result(result):
+                        return result
+                    if result is not None:
+                        last = result
+        finally:
+            for task in pending:
+                task.cancel()
+        if last is None:
+            self.decisions["failed"] += 1
+        return last
+
+    def stats(self):
+        return {
+            "hedge_delay_ms": round(self.get_hedge_delay() * 1000, 1),
+            "decisions": dict(self.decisions),
+            "providers": {self.primary.name: self.primary.stats(), self.secondary.name: self.secondary.stats()},
+        }
+
+
+upstream_router = UpstreamRouter("mihomo", "enka")
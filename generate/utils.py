@@ -1,150 +1,196 @@
-import datetime
-import io
+import asyncio
 import json
 import os
-import pathlib
-import pandas as pd
+import time
 
 import aiohttp
-from PIL import Image
-from starrailres import Index
+from msgspec import to_builtins
 from starrailres.models.info import CharacterBasicInfo, LevelInfo, LightConeBasicInfo, SubAffixBasicInfo, RelicBasicInfo
 
 import main
+from generate import http_client
+from generate.asset_mirror import asset_mirror, res_base_url
+from generate.backgrounds import background_cache
+from generate.image_cache import image_cache
+from generate.profile_cache import profile_cache
+from generate.profile_store import profile_store
+from generate.res_index import index_cache
+from generate.score_store import score_store, get_board_name
+from generate.upstream import upstream_router, UpstreamError
+from generate.weights import weight_registry
 
-conn = aiohttp.TCPConnector(limit_per_host=1)
+async def get_image_from_url(url: str):
+    # 手元に無ければ StarRailRes からそのままのバイト列でダウンロードする
+    replaced_path = url.replace(res_base_url, "")
+    return await asset_mirror.fetch(replaced_path)
 
 
-async def get_image_from_url(url: str):
-    replaced_path = url.replace("https://raw.githubusercontent.com/Mar-7th/StarRailRes/master/", "")
-    if url.startswith("https://raw.githubusercontent.com/Mar-7th/StarRailRes/master/") and os.path.exists(
-        f"{os.path.dirname(os.path.abspath(__file__))}/{replaced_path}"):
-        return f"{os.path.dirname(os.path.abspath(__file__))}/{replaced_path}"
-    print(f"{os.path.dirname(os.path.abspath(__file__))}/{replaced_path}")
-    filepath = pathlib.Path(f"{os.path.dirname(os.path.abspath(__file__))}/{replaced_path}")
-    filepath.parent.mkdir(parents=True, exist_ok=True)
-    async with aiohttp.ClientSession(connector_owner=False, connector=conn) as session:
-        async with session.get(url) as response:
-            Image.open(io.BytesIO(await response.content.read())).save(filepath, quality=95)
-            return f"{os.path.dirname(os.path.abspath(__file__))}/{replaced_path}"
+async def get_resized_image(url: str, size, crop=None):
+    # デコード・リサイズ済みの RGBA 画像 (共有されるので変更しないこと)
+    local_path = await get_image_from_url(url)
+    return image_cache.get(local_path, size, crop, digest=asset_mirror.get_digest(url.replace(res_base_url, "")))
 
 
-temp_json = {}
+def load_asset_image(path: str, size, crop=None, sprite_namespace=None, digest=None):
+    # 手元の StarRailRes の画像。まだ無い画像は透明で描く (描画中は通信しない)
+    try:
+        return image_cache.get(f"{os.path.dirname(os.path.abspath(__file__))}/{path}", size, crop, sprite_namespace,
+                               digest)
+    except FileNotFoundError:
+        if crop is not None:
+            size = (crop[2] - crop[0], crop[3] - crop[1])
+        return background_cache.get_tile((0, 0, 0, 0), size or (1, 1))
 
 
 async def get_json_from_url(uid: str, lang: str):
-    result_json = {}
+    key = (uid, lang)
+    result_json, state = profile_cache.get(key)
+    if state == "fresh":
+        return result_json
+    if state == "stale":
+        # 古いプロフィールを返して、裏で取り直す
+        if profile_cache.should_refresh(key):
+            http_client.profile_flight.start(key, lambda: fetch_json_from_url(uid, lang))
+        return result_json
+
+    if profile_store.enabled:
+        return await http_client.profile_flight.do(("store", uid, lang), lambda: load_json_from_store(uid, lang))
+    # 同じ (uid, lang) の同時リクエストはまとめて1回だけ取得する
+    return await http_client.profile_flight.do(key, lambda: fetch_json_from_url(uid, lang))
+
+
+async def load_json_from_store(uid: str, lang: str):
+    # ディスクに保存したプロフィールがあればそれを返して、裏で取り直す
+    key = (uid, lang)
+    result_json, fetched_at = await asyncio.to_thread(profile_store.load, key)
+    if result_json is None:
+        return await http_client.profile_flight.do(key, lambda: fetch_json_from_url(uid, lang))
+    profile_cache.put(key, result_json, fetched_at, stale=True)
+    if profile_cache.should_refresh(key):
+        http_client.profile_flight.start(key, lambda: fetch_json_from_url(uid, lang))
+    return result_json
 
-    # １分のインターバル
-    dt_now = datetime.datetime.now()
-    if uid in temp_json:
-        expires = temp_json[uid]["expires"]
-        if dt_now < expires:
-            return temp_json[uid]["result"]
 
-    try:
-        async with aiohttp.ClientSession(connector_owner=False, connector=conn) as session:
-            async with session.get(f"https://api.mihomo.me/sr_info_parsed/{uid}?lang={lang}", timeout=3) as response:
-                if response.status == 200:
-                    result_json = await response.json()
-    except Exception as e:
-        print("timeout mihomo?")
-        print(e)
-
-    if len(result_json.keys()) == 0 or "detail" in result_json:
-        uid = uid.replace("_enka", "")
-        filepath = pathlib.Path(f"{os.path.dirname(os.path.abspath(__file__))}/StarRailRes/index_min/{lang}")
-        index = Index(filepath)
+async def fetch_json_from_url(uid: str, lang: str):
+    key = (uid, lang)
+    fetched_at = time.time()
+    # mihomo が遅い・落ちているときは enka にも問い合わせて、先に届いた有効な結果を使う
+    result_json = await upstream_router.fetch(
+        None if uid.endswith("_enka") else lambda: fetch_mihomo_json(uid, lang),
+        lambda: fetch_enka_json(uid.replace("_enka", ""), lang))
+    if result_json is None:
+        result_json = {"detail": 408}
+    profile_cache.put(key, result_json, fetched_at)
+    if profile_store.enabled and "detail" not in result_json:
         try:
-            async with aiohttp.ClientSession(connector_owner=False, connector=conn) as session:
-                async with session.get(f"https://enka.network/api/hsr/uid/{uid}", timeout=7) as response:
-                    if response.status != 200:
-                        result_json["detail"] = response.status
-                        return result_json
-                    enka_result_json = await response.json()
-                    detail_info_json = enka_result_json["detailInfo"]
-                    record_info_json = detail_info_json["recordInfo"]
-                    result_json = {
-                        "player": {
-                            "uid": enka_result_json["uid"],
-                            "nickname": detail_info_json["nickname"],
-                            "level": detail_info_json["level"],
-                            "world_level": detail_info_json["worldLevel"],
-                            "friend_count": detail_info_json["friendCount"],
-                            "avatar": index.get_avatar_info(detail_info_json["headIcon"]),
-                            "signature": detail_info_json.get("signature", ""),
-                            "is_display": detail_info_json.get("isDisplayAvatar", True),
-                            "space_info": {
-                                "memory_data": {
-                                    "level": record_info_json.get("scheduleMaxLevel", 0),
-                                    "chaos_id": 0,
-                                    "chaos_level": 0
-                                },
-                                "universe_level": record_info_json["maxRogueChallengeScore"],
-                                "challenge_data": {
-                                    "maze_group_id": 0,
-                                    "maze_group_index": 0,
-                                    "pre_maze_group_index": record_info_json.get("scheduleMaxLevel", 0)
-                                },
-                                "pass_area_progress": record_info_json["maxRogueChallengeScore"],
-                                "light_cone_count": record_info_json["equipmentCount"],
-                                "avatar_count": record_info_json["avatarCount"],
-                                "achievement_count": record_info_json["achievementCount"]
-                            }
-                        }
-                    }
-                    characters_list = []
-                    for characters in detail_info_json["avatarDetailList"]:
-                        skill_list = []
-                        for skilltree in characters["skillTreeList"]:
-                            skill_list.append(LevelInfo(id=str(skilltree["pointId"]), level=int(skilltree["level"])))
-
-                        if "equipment" in characters:
-                            equipment = characters["equipment"]
-                            basic_light_cone = LightConeBasicInfo(id=str(equipment["tid"]), rank=int(equipment["rank"]),
-                                                                  level=int(equipment["level"]),
-                                                                  promotion=int(equipment.get("promotion", 0)))
-                        else:
-                            basic_light_cone = None
-
-                        basic_relics = []
-                        if "relicList" in characters:
-                            for relic in characters["relicList"]:
-                                subaffix_list = []
-                                for subaffix in relic["subAffixList"]:
-                                    subaffix_list.append(
-                                        SubAffixBasicInfo(id=str(subaffix["affixId"]), cnt=subaffix.get("cnt", 0),
-                                                          step=subaffix.get("step", 0)))
-                                basic_relics.append(RelicBasicInfo(
-                                    id=str(relic["tid"]),
-                                    level=relic.get("level", 0),
-                                    main_affix_id=str(relic["mainAffixId"]),
-                                    sub_affix_info=subaffix_list,
-                                ))
-
-                        charabase_json = index.get_character_info(CharacterBasicInfo(
-                            id=str(characters["avatarId"]),
-                            rank=characters.get("rank", 0),
-                            level=characters["level"],
-                            promotion=characters.get("promotion", 0),
-                            skill_tree_levels=skill_list,
-                            light_cone=basic_light_cone,
-                            relics=basic_relics,
-                        ))
-                        if charabase_json:
-                            from msgspec import to_builtins
-                            characters_list.append(to_builtins(charabase_json))
-                    result_json["characters"] = characters_list
+            await asyncio.to_thread(profile_store.save, key, result_json, fetched_at)
         except Exception as e:
-            print("timeout enka?")
+            print("profile store failed")
             print(e)
-            result_json["detail"] = 408
-    temp_in_json = {"expires": (dt_now + datetime.timedelta(minutes=1)), "result": result_json}
-    temp_json[uid] = temp_in_json
 
     return result_json
 
 
+async def fetch_mihomo_json(uid: str, lang: str):
+    async with http_client.get_session().get(f"https://api.mihomo.me/sr_info_parsed/{uid}?lang={lang}",
+                                             timeout=aiohttp.ClientTimeout(total=http_client.MIHOMO_TIMEOUT)) as response:
+        if response.status == 429 or response.status >= 500:
+            raise UpstreamError(f"mihomo {response.status}")
+        if response.status != 200:
+            return {"detail": response.status}
+        return await response.json()
+
+
+async def fetch_enka_json(uid: str, lang: str):
+    async with http_client.get_session().get(f"https://enka.network/api/hsr/uid/{uid}",
+                                             timeout=aiohttp.ClientTimeout(total=http_client.ENKA_TIMEOUT)) as response:
+        if response.status == 429 or response.status >= 500:
+            raise UpstreamError(f"enka {response.status}")
+        if response.status != 200:
+            return {"detail": response.status}
+        enka_result_json = await response.json()
+        # 変換は重いのでイベントループの外で行う
+        return await asyncio.to_thread(convert_enka_json, enka_result_json, lang)
+
+
+def convert_enka_json(enka_result_json, lang: str):
+    # enka の応答を sr_info_parsed (mihomo) と同じ形式にする
+    index = index_cache.get(lang)
+    detail_info_json = enka_result_json["detailInfo"]
+    record_info_json = detail_info_json["recordInfo"]
+    result_json = {
+        "player": {
+            "uid": enka_result_json["uid"],
+            "nickname": detail_info_json["nickname"],
+            "level": detail_info_json["level"],
+            "world_level": detail_info_json["worldLevel"],
+            "friend_count": detail_info_json["friendCount"],
+            "avatar": index.get_avatar_info(detail_info_json["headIcon"]),
+            "signature": detail_info_json.get("signature", ""),
+            "is_display": detail_info_json.get("isDisplayAvatar", True),
+            "space_info": {
+                "memory_data": {
+                    "level": record_info_json.get("scheduleMaxLevel", 0),
+                    "chaos_id": 0,
+                    "chaos_level": 0
+                },
+                "universe_level": record_info_json["maxRogueChallengeScore"],
+                "challenge_data": {
+                    "maze_group_id": 0,
+                    "maze_group_index": 0,
+                    "pre_maze_group_index": record_info_json.get("scheduleMaxLevel", 0)
+                },
+                "pass_area_progress": record_info_json["maxRogueChallengeScore"],
+                "light_cone_count": record_info_json["equipmentCount"],
+                "avatar_count": record_info_json["avatarCount"],
+                "achievement_count": record_info_json["achievementCount"]
+            }
+        }
+    }
+    basic_characters = []
+    for characters in detail_info_json["avatarDetailList"]:
+        skill_list = []
+        for skilltree in characters["skillTreeList"]:
+            skill_list.append(LevelInfo(id=str(skilltree["pointId"]), level=int(skilltree["level"])))
+
+        if "equipment" in characters:
+            equipment = characters["equipment"]
+            basic_light_cone = LightConeBasicInfo(id=str(equipment["tid"]), rank=int(equipment["rank"]),
+                                                  level=int(equipment["level"]),
+                                                  promotion=int(equipment.get("promotion", 0)))
+        else:
+            basic_light_cone = None
+
+        basic_relics = []
+        if "relicList" in characters:
+            for relic in characters["relicList"]:
+                subaffix_list = []
+                for subaffix in relic["subAffixList"]:
+                    subaffix_list.append(
+                        SubAffixBasicInfo(id=str(subaffix["affixId"]), cnt=subaffix.get("cnt", 0),
+                                          step=subaffix.get("step", 0)))
+                basic_relics.append(RelicBasicInfo(
+                    id=str(relic["tid"]),
+                    level=relic.get("level", 0),
+                    main_affix_id=str(relic["mainAffixId"]),
+                    sub_affix_info=subaffix_list,
+                ))
+
+        basic_characters.append(CharacterBasicInfo(
+            id=str(characters["avatarId"]),
+            rank=characters.get("rank", 0),
+            level=characters["level"],
+            promotion=characters.get("promotion", 0),
+            skill_tree_levels=skill_list,
+            light_cone=basic_light_cone,
+            relics=basic_relics,
+        ))
+    # 全キャラをまとめて変換する
+    characters_list = [index.get_character_info(basic_character) for basic_character in basic_characters]
+    result_json["characters"] = to_builtins([charabase_json for charabase_json in characters_list if charabase_json])
+    return result_json
+
+
 def get_json_from_json(json_list, key, value):
     for i in json_list:
         if i[key] == value:
@@ -176,21 +222,17 @@ def convert_old_roman_from_int(n):
     return r[n - 1]
 
 
-async def get_relic_score(chara_id, relic_json):
+def get_relic_score(chara_id, relic_json):
     chara_id_number = chara_id.split("_")[0]
     if int(chara_id_number) >= 8000 and int(chara_id_number)%2 == 0:
         chara_id.replace(chara_id_number, str(int(chara_id_number) - 1))
-    # load
-    with open(f"{os.path.dirname(os.path.abspath(__file__))}/StarRailScore/score.json") as f:
-        weight_json = json.load(f)
-    with open(f"{os.path.dirname(os.path.abspath(__file__))}/max.json") as f:
-        max_json = json.load(f)
-    with open(f"{os.path.dirname(os.path.abspath(__file__))}/relic_id.json") as f:
-        relic_id_json = json.load(f)
+    weight_data = weight_registry.data
+    max_json = weight_data.max
     result_json = {}
 
     # メインの計算
-    if chara_id not in weight_json:
+    character_weight = weight_data.characters.get(chara_id)
+    if character_weight is None:
         result_json["main_formula"] = "-"
         result_json["score"] = 0
         sub_affix_formulas = []
@@ -199,28 +241,27 @@ async def get_relic_score(chara_id, relic_json):
         result_json["sub_formulas"] = sub_affix_formulas
         return result_json
 
-    main_weight = weight_json[chara_id]["main"]["w" + relic_id_json.get(relic_json["id"], relic_json["id"])[-1]][
+    main_weight = character_weight.main["w" + weight_data.relic_id.get(relic_json["id"], relic_json["id"])[-1]][
         relic_json["main_affix"]["type"]]
     main_affix_score = (relic_json["level"] + 1) / 16 * main_weight
     result_json[
         "main_formula"] = f'{round((relic_json["level"] + 1) / 16 * 100, 1)}×{main_weight}={main_affix_score * 100}'
 
     # サブの計算
+    sub_weight = character_weight.weight
     sub_affix_score = 0
     sub_affix_formulas = []
     for sub_affix_json in relic_json["sub_affix"]:
         sub_affix_type = sub_affix_json["type"]
-        # print(f"{weight_json[chara_id]['weight'][sub_affix_type]}/{sub_affix_type}")
-        # print(f"{weight_json[chara_id]['weight']}")
-        score = (sub_affix_json["value"] / max_json[sub_affix_type]) * weight_json[chara_id]["weight"][sub_affix_type]
+        score = (sub_affix_json["value"] / max_json[sub_affix_type]) * sub_weight[sub_affix_type]
         sub_affix_score += score
         sub_affix_formulas.append(
-            f'{round(sub_affix_json["value"] / max_json[sub_affix_type] * 100, 1)}×{round(weight_json[chara_id]["weight"][sub_affix_type], 1)}')
+            f'{round(sub_affix_json["value"] / max_json[sub_affix_type] * 100, 1)}×{round(sub_weight[sub_affix_type], 1)}')
 
     result_json["score"] = main_affix_score * 0.5 + sub_affix_score * 0.5
     result_json["sub_formulas"] = sub_affix_formulas
-    if "lang" in weight_json[chara_id]:
-        result_json["name"] = weight_json[chara_id]["lang"]["jp"]
+    if character_weight.name is not None:
+        result_json["name"] = character_weight.name
 
     # 合計
     return result_json
@@ -273,24 +314,22 @@ def get_relic_full_score_text(score):
         return "OP"
 
 
-async def get_relic_sets_score(chara_id, relic_sets):
+def get_relic_sets_score(chara_id, relic_sets):
     chara_id_number = chara_id.split("_")[0]
     if int(chara_id_number) >= 8000 and int(chara_id_number)%2 == 0:
         chara_id.replace(chara_id_number, str(int(chara_id_number) - 1))
 
-    # load
-    with open(f"{os.path.dirname(os.path.abspath(__file__))}/StarRailScore/score.json") as f:
-        weight_json = json.load(f)
+    character_weight = weight_registry.data.characters.get(chara_id)
 
     result_json = {}
 
     # Check if character exists in weight_json
-    if chara_id not in weight_json:
+    if character_weight is None:
         result_json["score"] = 0
         return result_json
 
     # Check if relic_sets weights exist for this character
-    if "relic_sets" not in weight_json[chara_id]:
+    if character_weight.relic_sets is None:
         result_json["score"] = 0
         return result_json
 
@@ -301,13 +340,7 @@ async def get_relic_sets_score(chara_id, relic_sets):
     for relic_set in relic_sets:
         set_id = relic_set["id"]
         set_num = relic_set["num"]
-        set_score = 0
-
-        # Find weight for this set
-        for weight_set in weight_json[chara_id]["relic_sets"]:
-            if weight_set["id"] == set_id and weight_set["num"] == set_num:
-                set_score = weight_set["weight"]
-                break
+        set_score = character_weight.relic_sets.get((set_id, set_num), 0)
 
         set_scores.append({
             "id": set_id,
@@ -325,8 +358,8 @@ async def get_relic_sets_score(chara_id, relic_sets):
     result_json["score"] = total_score
     result_json["set_scores"] = set_scores
 
-    if "lang" in weight_json[chara_id]:
-        result_json["name"] = weight_json[chara_id]["lang"]["jp"]
+    if character_weight.name is not None:
+        result_json["name"] = character_weight.name
 
     return result_json
 
@@ -361,14 +394,11 @@ def get_mihomo_lang(discord_lang):
 
 
 def get_weight(chara_id):
-    with open(f"{os.path.dirname(os.path.abspath(__file__))}/StarRailScore/score.json") as f:
-        weight_json = json.load(f)
-    return weight_json[str(chara_id)]["weight"]
+    return weight_registry.data.raw[str(chara_id)]["weight"]
 
 
 def get_all_weight(chara_id):
-    with open(f"{os.path.dirname(os.path.abspath(__file__))}/StarRailScore/score.json") as f:
-        weight_json = json.load(f)
+    weight_json = weight_registry.data.raw
     if chara_id is None:
         return weight_json
     if str(chara_id) not in weight_json:
@@ -376,33 +406,26 @@ def get_all_weight(chara_id):
     return weight_json[str(chara_id)]
 
 
+def round_score(value):
+    # 以前の pandas (numpy) 実装と同じ丸め方
+    return round(value * 10) / 10
+
+
 def get_score_rank(chara_id, uid, score, calculation_value="compatibility"):
-    if calculation_value != "compatibility" and calculation_value != "no_score":
-        json_path = f"{os.path.dirname(os.path.abspath(__file__))}/scores/{chara_id}_{calculation_value}.json"
-    else:
-        json_path = f"{os.path.dirname(os.path.abspath(__file__))}/scores/{chara_id}.json"
+    board = get_board_name(chara_id, calculation_value)
+    before_score, rank, data_count, median, mean = score_store.record(board, uid, score)
     result = {}
-    if os.path.exists(json_path):
-        df = pd.read_json(json_path, orient='columns')
-    else:
-        df = pd.DataFrame({"score": {}, "rank": {}})
-    uid = str(uid) + 'u'
-    before_score = df["score"].get(uid, 0)
-    df.loc[uid, "score"] = score
-    df.loc[uid, "rank"] = 0
-    df['rank'] = df['score'].rank(ascending=False, method='min')
+    if before_score is None:
+        before_score = 0
     if before_score > score:
-        df.loc[uid, "score"] = before_score
-        result['top_score'] = str(round(before_score, 1))
+        result['top_score'] = str(round_score(before_score))
     else:
         result['top_score'] = str(round(score, 1))
 
-    df.to_json(json_path)
-
     result["before_score"] = str(before_score)
-    result['median'] = str(round(df.median()['score'], 1))
-    result['mean'] = str(round(df.mean()['score'], 1))
-    result['rank'] = str(int(round(df['rank'].get(uid, 1), 0)))
-    result['data_count'] = str(len(df))
+    result['median'] = str(round_score(median))
+    result['mean'] = str(round_score(mean))
+    result['rank'] = str(rank)
+    result['data_count'] = str(data_count)
 
     return result
@@ -0,0 +1,104 @@
+import datetime
+import hashlib
+import json
+import os
+import threading
+
+from generate.data_version import data_version
+
+score_json_path = f"{os.path.dirname(os.path.abspath(__file__))}/StarRailScore/score.json"
+max_json_path = f"{os.path.dirname(os.path.abspath(__file__))}/max.json"
+relic_id_json_path = f"{os.path.dirname(os.path.abspath(__file__))}/relic_id.json"
+
+
+class CharacterWeight:
+    __slots__ = ("main", "weight", "relic_sets", "name")
+
+    def __init__(self, weight_json):
+        # main: "w1".."w6" -> {メインステータス: 重み}
+        self.main = weight_json["main"]
+        self.weight = weight_json["weight"]
+        if "relic_sets" in weight_json:
+            self.relic_sets = {}
+            for weight_set in weight_json["relic_sets"]:
+                self.relic_sets.setdefault((weight_set["id"], weight_set["num"]), weight_set["weight"])
+        else:
+            self.relic_sets = None
+        self.name = weight_json["lang"]["jp"] if "lang" in weight_json else None
+
+
+class WeightData:
+    """One immutable snapshot of score.json, max.json and relic_id.json."""
+
+    def __init__(self, version, generation, digest, weight_json, max_json, relic_id_json):
+        self.version = version
+        self.generation = generation
+        # 3ファイルの内容のハッシュ (再起動をまたいでも同じ重みなら同じ値)
+        self.digest = digest
+        self.loaded_at = datetime.datetime.now()
+        self.raw = weight_json
+        self.max = max_json
+        self.relic_id = relic_id_json
+        self.characters = {chara_id: CharacterWeight(v) for chara_id, v in weight_json.items()}
+
+
+class WeightRegistry:
+    def __init__(self):
+        self._data = None
+        self._lock = threading.Lock()
+
+    @property
+    def data(self):
+        # weights の世代が変わっていたら読み直す (StarRailScore が git でなくても反映される)
+        data = self._data
+        if data is None or data.generation != data_version.get("weights"):
+            data = self.refresh()
+        return data
+
+    @property
+    def version(self):
+        return self.data.version
+
+    def refresh(self, force=False):
+        # weights の世代が変わっていれば読み直して差し替える (失敗したら前のデータを使い続ける)
+        with self._lock:
+            generation = data_version.get("weights")
+            if not force and self._data is not None and self._data.generation == generation:
+                return self._data
+            try:
+                contents = []
+                for path in (score_json_path, max_json_path, relic_id_json_path):
+                    with open(path, 'rb') as f:
+                        contents.append(f.read())
+                weight_json, max_json, relic_id_json = (json.loads(content) for content in contents)
+                digest = hashlib.sha1(b"\0".join(contents)).hexdigest()
+                version = self._data.version + 1 if self._data is not None else 1
+                self._data = WeightData(version, generation, digest, weight_json, max_json, relic_id_json)
+            except (OSError, ValueError, KeyError) as e:
+                if self._data is None:
+                    raise
+                print("weight reload failed")
+                print(e)
+            return self._data
+
+    def save(self, weight_json):
+        # score.json を一時ファイル経由で置き換えてから読み直す
+        tmp_path = f"{score_json_path}.tmp"
+        with open(tmp_path, 'wt', encoding='utf-8') as f:
+            json.dump(weight_json, f, ensure_ascii=False, indent=4, sort_keys=True, separators=(',', ': '))
+        os.replace(tmp_path, score_json_path)
+        data_version.refresh(["weights"])
+        return self.refresh(force=True)
+
+    def stats(self):
+        data = self.data
+        return {
+            "version": data.version,
+            "generation": data.generation,
+            "digest": data.digest,
+            "characters": len(data.characters),
+            "loaded_at": data.loaded_at.isoformat(),
+        }
+
+
+weight_registry = WeightRegistry()
@@ -1,7 +1,10 @@
-import datetime
+import asyncio
+import base64
 import io
 import json
 import os
+import zipfile
+from typing import List
 
 import aiofiles
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
@@ -11,12 +14,31 @@ from starlette.middleware.cors import CORSMiddleware
 import sentry_sdk
 
 import i18n
-from fastapi import FastAPI, HTTPException, Request, status
+from fastapi import FastAPI, HTTPException, Query, Request, status
 from fastapi.encoders import jsonable_encoder
 from starlette.responses import StreamingResponse, Response, JSONResponse
 from apscheduler.schedulers.background import BackgroundScheduler
 
 import generate.generate
+from generate import http_client, render
+from generate.asset_mirror import asset_mirror
+from generate.backgrounds import background_cache
+from generate.card_cache import card_cache
+from generate.data_sync import data_sync
+from generate.data_version import data_version
+from generate.encode import media_types, negotiate_format, image_extensions
+from generate.fonts import font_registry
+from generate.image_cache import image_cache
+from generate.profile_cache import profile_cache
+from generate.profile_store import profile_store
+from generate.render import RenderQueueFull
+from generate.res_index import index_cache
+from generate.score_store import score_store, get_board_name
+from generate.sprites import sprite_store
+from generate.static_index import static_index, negotiate_encoding
+from generate.templates import two
+from generate.upstream import upstream_router
+from generate.weights import weight_registry
 from generate.utils import get_score_rank
 
 load_dotenv()
@@ -84,45 +106,213 @@ async def validate_ip(request: Request, call_next):
     # Proceed if IP is allowed
     return await call_next(request)
 
+def static_index_response(request, lang, name):
+    # 読み込み・圧縮済みのバイト列を返す (JSON は解析しない)
+    payload = static_index.get(lang, name)
+    if payload is None:
+        raise HTTPException(status_code=404)
+    headers = {"ETag": f'"{payload.etag}"', "Vary": "Accept-Encoding"}
+    if is_etag_matched(request.headers.get("if-none-match"), payload.etag):
+        return Response(status_code=304, headers=headers)
+    encoding = negotiate_encoding(request.headers.get("accept-encoding"), payload.bodies)
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(content=payload.bodies[encoding], headers=headers, media_type="application/json")
+
 @app.get("/get_chara")
-async def get_chara(lang: str = "jp"):
-    async with aiofiles.open(f"{os.path.dirname(os.path.abspath(__file__))}/generate/StarRailRes/index_min/{lang}/characters.json", mode='r',
-              encoding='utf-8') as f:
-        contents = await f.read()
-    return JSONResponse(content=json.loads(contents))
+async def get_chara(request: Request, lang: str = "jp"):
+    return static_index_response(request, lang, "characters")
 
 @app.get("/get_set_relic")
-async def get_set_relic(lang: str = "jp"):
-    async with aiofiles.open(f"{os.path.dirname(os.path.abspath(__file__))}/generate/StarRailRes/index_min/{lang}/relic_sets.json", mode='r',
-              encoding='utf-8') as f:
-        contents = await f.read()
-    return JSONResponse(content=json.loads(contents))
+async def get_set_relic(request: Request, lang: str = "jp"):
+    return static_index_response(request, lang, "relic_sets")
+
+@app.get("/stats")
+async def stats():
+    return JSONResponse(content={"image_cache": image_cache.stats(), "render": render.stats(),
+                                 "weights": weight_registry.stats(), "card_cache": card_cache.stats(),
+                                 "backgrounds": background_cache.stats(), "fonts": font_registry.stats(),
+                                 "http": http_client.stats(), "profile_cache": profile_cache.stats(),
+                                 "profile_store": profile_store.stats(), "upstream": upstream_router.stats(),
+                                 "res_index": index_cache.stats(),
+                                 "static_index": static_index.stats(), "data_sync": data_sync.stats(),
+                                 "data_version": data_version.stats(), "assets": asset_mirror.stats(),
+                                 "sprites": sprite_store.stats(), "scores": score_store.stats()})
+
+
+@app.get("/healthz")
+async def healthz():
+    # プロセスが動いていれば OK (データの読み込みは待たない)
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+async def readyz():
+    # StarRailRes を読み込むまでは 503
+    ready = data_sync.is_ready()
+    return JSONResponse(status_code=200 if ready else 503,
+                        content={"ready": ready, "loaded": data_sync.loaded})
 
 @app.get("/sentry-debug")
 async def trigger_error():
     division_by_zero = 1 / 0
 
+def is_etag_matched(if_none_match, etag):
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return etag in (tag.strip().removeprefix("W/").strip('"') for tag in if_none_match.split(","))
+
+
 @app.get("/gen_card/{uid}")
-async def gen_card(uid: str, select_number: int, is_uid_hide: bool = False, is_hide_roll: bool = False,
-                   calculation_value: str = "compatibility", lang: str = "jp"):
-    image_binary = io.BytesIO()
-    panel_img = await generate.generate.generate_panel(uid=uid, chara_id=int(select_number), template=2,
-                                                       is_hideUID=is_uid_hide
-                                                       , calculating_standard=calculation_value, lang=lang,
-                                                       is_hide_roll=is_hide_roll)
+async def gen_card(request: Request, uid: str, select_number: int, is_uid_hide: bool = False,
+                   is_hide_roll: bool = False, calculation_value: str = "compatibility", lang: str = "jp",
+                   format: str = None, quality: int = None, width: int = two.default_width):
+    # format 未指定なら Accept ヘッダーから選ぶ
+    image_format = format or negotiate_format(request.headers.get("accept"))
+    if image_format not in media_types or (quality is not None and not 1 <= quality <= 100):
+        raise HTTPException(status_code=400)
+    if not two.min_width <= width <= two.max_width:
+        raise HTTPException(status_code=400)
+    if_none_match = request.headers.get("if-none-match")
+    try:
+        # ETag が一致すれば描画せずに 304 を返す
+        panel_img = await generate.generate.generate_panel(uid=uid, chara_id=int(select_number), template=2,
+                                                           is_hideUID=is_uid_hide
+                                                           , calculating_standard=calculation_value, lang=lang,
+                                                           is_hide_roll=is_hide_roll, image_format=image_format,
+                                                           quality=quality, width=width,
+                                                           not_modified=lambda etag: is_etag_matched(if_none_match,
+                                                                                                     etag))
+    except RenderQueueFull:
+        raise HTTPException(status_code=503)
     if "detail" in panel_img:
         raise HTTPException(status_code=panel_img["detail"])
-    panel_img['img'].save(image_binary, 'PNG', optimize=True)
-    image_binary.seek(0)
     score_rank = get_score_rank(int(panel_img['avatar_id']), uid, panel_img['score'], calculation_value=calculation_value)
-    return Response(content=image_binary.getvalue(),
-                    headers={"X-score": str(panel_img["score"]), "X-top-score": score_rank['top_score'],
-                             'X-before-score': score_rank['before_score'], 'X-median': score_rank['median'],
-                             'X-mean': score_rank['mean'], 'X-rank': score_rank['rank'],
-                             'X-data-count': score_rank['data_count'],
-                             'Access-Control-Allow-Origin': '*',
-                             'Access-Control-Expose-Headers': '*'},
-                    media_type="image/png")
+    headers = {"X-score": str(panel_img["score"]), "X-top-score": score_rank['top_score'],
+               'X-before-score': score_rank['before_score'], 'X-median': score_rank['median'],
+               'X-mean': score_rank['mean'], 'X-rank': score_rank['rank'],
+               'X-data-count': score_rank['data_count'],
+               'X-cache': panel_img['cache'],
+               'ETag': f'"{panel_img["etag"]}"',
+               'Vary': 'Accept',
+               'Access-Control-Allow-Origin': '*',
+               'Access-Control-Expose-Headers': '*'}
+    if panel_img['cache'] == "MISS":
+        headers['X-render-time'] = str(panel_img['render_ms'])
+    if panel_img['missing_assets']:
+        # 画像が揃っていない (揃えば ETag が変わる)
+        headers['X-missing-assets'] = str(panel_img['missing_assets'])
+    if panel_img.get("not_modified"):
+        return Response(status_code=304, headers=headers)
+    return Response(content=panel_img['image'], headers=headers, media_type=panel_img['media_type'])
+
+
+def ndjson_line(value):
+    return json.dumps(value, ensure_ascii=False) + "\n"
+
+
+async def stream_card(uid, select_number, is_uid_hide, is_hide_roll, calculation_value, lang, image_format, quality,
+                      width):
+    # プロフィール → スコアと順位 → 画像 の順に1行ずつ送る (スコアは描画を待たない)
+    profile_json = await generate.utils.get_json_from_url(uid, lang)
+    if "detail" in profile_json:
+        yield ndjson_line({"type": "error", "detail": profile_json["detail"]})
+        return
+    if not 0 <= select_number < len(profile_json["characters"]):
+        yield ndjson_line({"type": "error", "detail": 400})
+        return
+    helta_json = profile_json["characters"][select_number]
+    render_task = asyncio.ensure_future(two.generate_character_panel(
+        profile_json, select_number, is_uid_hide, calculation_value, lang, is_hide_roll, image_format, quality, width))
+    try:
+        yield ndjson_line({"type": "profile",
+                           "uid": profile_json["player"]["uid"],
+                           "nickname": profile_json["player"].get("nickname"),
+                           "level": profile_json["player"].get("level"),
+                           "character": {"avatar_id": helta_json["id"], "name": helta_json["name"],
+                                         "level": helta_json["level"], "rarity": helta_json["rarity"],
+                                         "element": helta_json["element"].get("name")}})
+
+        panel_score = two.get_panel_score(helta_json, calculation_value)
+        score_rank = get_score_rank(int(helta_json["id"]), uid, panel_score["total_score"],
+                                    calculation_value=calculation_value)
+        yield ndjson_line({"type": "score", "score": panel_score["total_score"],
+                           "relic_scores": panel_score["relic_score_values"],
+                           "relic_sets_score": panel_score["relic_sets_score"], **score_rank})
+
+        try:
+            panel_img = await render_task
+        except RenderQueueFull:
+            yield ndjson_line({"type": "error", "detail": 503})
+            return
+        if "detail" in panel_img:
+            yield ndjson_line({"type": "error", "detail": panel_img["detail"]})
+            return
+        yield ndjson_line({"type": "image", "media_type": panel_img["media_type"], "etag": panel_img["etag"],
+                           "cache": panel_img["cache"], "render_ms": panel_img.get("render_ms"),
+                           "image": base64.b64encode(panel_img["image"]).decode("ascii")})
+    finally:
+        # 途中で切断されたら描画を待たない (描画自体はキャッシュのために続く)
+        render_task.cancel()
+
+
+@app.get("/gen_card_stream/{uid}")
+async def gen_card_stream(request: Request, uid: str, select_number: int, is_uid_hide: bool = False,
+                          is_hide_roll: bool = False, calculation_value: str = "compatibility", lang: str = "jp",
+                          format: str = None, quality: int = None, width: int = two.default_width):
+    # gen_card の NDJSON 版。画像は base64 で最後の行に入る
+    image_format = format or negotiate_format(request.headers.get("accept"))
+    if image_format not in media_types or (quality is not None and not 1 <= quality <= 100):
+        raise HTTPException(status_code=400)
+    if not two.min_width <= width <= two.max_width:
+        raise HTTPException(status_code=400)
+    headers = {"Cache-Control": "no-store",
+               "X-Accel-Buffering": "no",
+               'Access-Control-Allow-Origin': '*',
+               'Access-Control-Expose-Headers': '*'}
+    return StreamingResponse(stream_card(uid, select_number, is_uid_hide, is_hide_roll, calculation_value, lang,
+                                         image_format, quality, width),
+                             headers=headers, media_type="application/x-ndjson")
+
+
+@app.get("/gen_cards/{uid}")
+async def gen_cards(uid: str, select_number: List[int] = Query(None), is_uid_hide: bool = False,
+                    is_hide_roll: bool = False, calculation_value: str = "compatibility", lang: str = "jp",
+                    format: str = "png", quality: int = None, width: int = two.default_width):
+    # 全キャラ (select_number で指定したキャラ) の画像と metadata.json を zip で返す
+    if format not in media_types or (quality is not None and not 1 <= quality <= 100):
+        raise HTTPException(status_code=400)
+    if not two.min_width <= width <= two.max_width:
+        raise HTTPException(status_code=400)
+    try:
+        result = await generate.generate.generate_panels(uid=uid, chara_ids=select_number, is_hideUID=is_uid_hide,
+                                                         calculating_standard=calculation_value, lang=lang,
+                                                         is_hide_roll=is_hide_roll, image_format=format,
+                                                         quality=quality, width=width)
+    except RenderQueueFull:
+        raise HTTPException(status_code=503)
+    if "detail" in result:
+        raise HTTPException(status_code=result["detail"])
+    metadata = {"uid": uid, "calculation_value": calculation_value, "lang": lang, "characters": []}
+    buffer = io.BytesIO()
+    # 画像は圧縮済みなので無圧縮で格納する
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as zip_file:
+        for chara_id, panel_img in zip(result["chara_ids"], result["panels"]):
+            score_rank = get_score_rank(int(panel_img['avatar_id']), uid, panel_img['score'],
+                                        calculation_value=calculation_value)
+            file_name = f"{chara_id}_{panel_img['avatar_id']}.{image_extensions[format]}"
+            zip_file.writestr(file_name, panel_img['image'])
+            metadata["characters"].append({"select_number": chara_id, "avatar_id": panel_img['avatar_id'],
+                                           "chara_name": panel_img['chara_name'], "file": file_name,
+                                           "score": panel_img['score'], "cache": panel_img['cache'],
+                                           "etag": panel_img['etag'], **score_rank})
+        zip_file.writestr("metadata.json", json.dumps(metadata, ensure_ascii=False, indent=2))
+    headers = {"Content-Disposition": f'attachment; filename="{uid}.zip"',
+               'Access-Control-Allow-Origin': '*',
+               'Access-Control-Expose-Headers': '*'}
+    return Response(content=buffer.getvalue(), headers=headers, media_type="application/zip")
 
 
 @app.get("/sr_info_parsed/{uid}")
@@ -234,9 +424,7 @@ async def post_weight(weight: Weight, chara_id: str):
         content = await f.read()
         weight_json = json.loads(content)
     weight_json[chara_id] = weight.model_dump()
-    with open(f"{os.path.dirname(os.path.abspath(__file__))}/generate/StarRailScore/score.json", 'wt',
-              encoding='utf-8') as f:
-        json.dump(weight_json, f, ensure_ascii=False, indent=4, sort_keys=True, separators=(',', ': '))
+    weight_registry.save(weight_json)
     return {"done": True}
 
 
@@ -270,9 +458,7 @@ async def put_weight(weight: Weight, chara_id: str):
             if not found:
                 weight_json[chara_id]["relic_sets"].append(relic_set)
 
-    with open(f"{os.path.dirname(os.path.abspath(__file__))}/generate/StarRailScore/score.json", 'wt',
-              encoding='utf-8') as f:
-        json.dump(weight_json, f, ensure_ascii=False, indent=4, sort_keys=True, separators=(',', ': '))
+    weight_registry.save(weight_json)
     return {"done": True}
 
 
@@ -287,56 +473,95 @@ async def get_weight_list(chara_id: str):
             avatar_id = key_parts[0]
 
             # calculation_value を判定
-            if len(key_parts) > 1 and key_parts[1] not in ["compatibility", "no_score"]:
+            if len(key_parts) > 1:
                 calculation_value = key_parts[1]
-                json_path = f"{os.path.dirname(os.path.abspath(__file__))}/generate/scores/{avatar_id}_{calculation_value}.json"
-            else:
-                json_path = f"{os.path.dirname(os.path.abspath(__file__))}/generate/scores/{avatar_id}.json"
-
-            # データ数を取得
-            if os.path.exists(json_path):
-                try:
-                    import pandas as pd
-                    df = pd.read_json(json_path, orient='columns')
-                    data_count = len(df)
-                except:
-                    data_count = 0
             else:
-                data_count = 0
+                calculation_value = "compatibility"
+
+            # データ数を取得 (メモリ上の登録数)
+            data_count, count_updated_at = score_store.get_count(get_board_name(avatar_id, calculation_value))
 
             # valueに登録数を追加
             value_with_count = value.copy() if isinstance(value, dict) else value
             if isinstance(value_with_count, dict):
                 value_with_count["data_count"] = data_count
+                value_with_count["data_count_updated_at"] = count_updated_at.isoformat() if count_updated_at else None
             weight_list[key] = value_with_count
     return JSONResponse(content=jsonable_encoder(weight_list))
 
 
 async def remove_temp_task():
-    dt_now = datetime.datetime.now()
-    for k, v in list(generate.utils.temp_json.items()):
-        if dt_now > v["expires"]:
-            generate.utils.temp_json.pop(k, None)
+    # 期限切れのプロフィールを捨てる (期限順のヒープから取り出すだけ)
+    profile_cache.expire()
+    if profile_store.enabled:
+        await asyncio.to_thread(profile_store.prune)
+    await asyncio.to_thread(asset_mirror.save_manifest)
+
+
+async def sync_data_task():
+    await data_sync.sync_all()
+    # 手で置き換えたファイル (rolls.json など) もここで拾う
+    changed = await asyncio.to_thread(data_version.refresh)
+    if changed:
+        print(f"data version {data_version.version}: {', '.join(changed)}")
+    if "weights" in changed:
+        # リクエストの中で読み直さないように先に読み込んでおく
+        await asyncio.to_thread(weight_registry.refresh)
+
+
+async def reload_res_data():
+    # 変わったグループのキャッシュだけが作り直される
+    await asyncio.to_thread(data_version.refresh, ["res_index"])
+    await asyncio.to_thread(index_cache.reload)
+    await asyncio.to_thread(static_index.preload)
+    # 新しく増えたアイコン・立ち絵を裏でまとめてダウンロードして、縮小済みの画像を作る
+    app.state.asset_task = asyncio.ensure_future(prepare_assets_task())
+
+
+async def prepare_assets_task():
+    await asset_mirror.start_prefetch([generate.utils.get_star_image_path_from_int(i) for i in range(1, 6)])
+    built = await asyncio.to_thread(two.build_sprites)
+    if built:
+        print(f"built {built} sprites")
+
+
+async def reload_score_data():
+    await asyncio.to_thread(data_version.refresh, ["weights"])
+    await asyncio.to_thread(weight_registry.refresh)
 
 
-async def update_weight_task():
-    os.chdir(f"{os.path.dirname(os.path.abspath(__file__))}/generate")
-    os.chdir('StarRailScore')
-    os.system("git checkout")
-    os.system("git pull")
+data_sync.on_change("StarRailRes", reload_res_data)
+data_sync.on_change("StarRailScore", reload_score_data)
 
 
 @app.on_event("startup")
 async def skd_process():
+    # スレッドが動き出す前にデータの版を求めてレンダープールのプロセスを作る (背景とフォントは各ワーカーで用意する)
+    data_version.refresh()
+    render.start(initializer=two.preload_render_worker, initargs=(data_version.snapshot(),))
     scheduler = AsyncIOScheduler()
     scheduler.add_job(remove_temp_task, "interval", minutes=1)
-    scheduler.add_job(update_weight_task, "interval", minutes=60)
-    os.chdir(f"{os.path.dirname(os.path.abspath(__file__))}/generate")
-    os.system("git clone --filter=blob:none --no-checkout https://github.com/Mar-7th/StarRailRes.git")
-    # os.system("git clone --filter=blob:none --no-checkout https://github.com/lenlino/StarRailScore.git")
-    os.chdir('StarRailRes')
-    os.system("git sparse-checkout set index_min")
-    os.system("git checkout")
-    os.system("git pull")
-    # await update_weight_task()
+    scheduler.add_job(sync_data_task, "interval", minutes=60)
+    await asyncio.to_thread(score_store.rebuild_counts)
+    await asyncio.to_thread(asset_mirror.load)
     scheduler.start()
+    await http_client.start()
+    # 手元の checkout ですぐに動き始め、git の更新は裏で行う
+    await data_sync.load("StarRailRes")
+    await data_sync.load("StarRailScore")
+    app.state.data_sync_task = asyncio.create_task(sync_data_task())
+
+
+@app.on_event("shutdown")
+async def shutdown_process():
+    data_sync_task = getattr(app.state, "data_sync_task", None)
+    if data_sync_task is not None:
+        data_sync_task.cancel()
+    asset_task = getattr(app.state, "asset_task", None)
+    if asset_task is not None:
+        asset_task.cancel()
+    asset_mirror.stop()
+    asset_mirror.save_manifest()
+    render.shutdown()
+    await http_client.close()
+    profile_store.close()